@@ -369,6 +369,8 @@ namespace RHVoice
     sentence_position pos=sentence_position_initial;
     for(iterator it(begin());it!=end();++it)
       {
+        if(get_owner().is_cancelled())
+          break;
         if(!(it->has_text()))
           {
             if(it->notify_client())
@@ -386,6 +388,8 @@ namespace RHVoice
               pos=sentence_position_final;
           }
         u=it->create_utterance(pos);
+        if(get_owner().is_cancelled())
+          break;
         if((u.get()!=0)&&(u->has_voice()))
           if(!(u->get_voice().synthesize(*u,get_owner())))
             break;
@@ -14,6 +14,9 @@
 /* along with this program.  If not, see <http://www.gnu.org/licenses/>. */
 
 #include <sstream>
+#include <cstring>
+#include <iterator>
+#include <utility>
 #include "core/exception.hpp"
 #include "core/dtree.hpp"
 
@@ -29,6 +32,18 @@ namespace RHVoice
     const unsigned int condition_grater=3;
     const unsigned int condition_in=4;
     const std::string err_msg("Incorrect format of the decision tree file");
+    const char compact_magic[4]={'R','H','D','T'};
+    const uint32_t compact_version=1;
+    const std::size_t header_size=32;
+    const std::size_t node_size=20;
+    const uint32_t number_flag=0x80000000;
+    const uint32_t no_value=0xffffffff;
+    const std::size_t max_cached_features=32;
+
+    inline bool has_compact_magic(const char* data,std::size_t size)
+    {
+      return ((size>=sizeof(compact_magic))&&(std::memcmp(data,compact_magic,sizeof(compact_magic))==0));
+    }
 
     inline unsigned int read_number(std::istream& in)
     {
@@ -170,6 +185,239 @@ namespace RHVoice
     return (((question->test(f.eval(feature_name)))?yes_node:no_node).get());
   }
 
+  dtree::compact_tree::compact_tree(const char* data,std::size_t size)
+  {
+    const unsigned char* begin=reinterpret_cast<const unsigned char*>(data);
+    if((size<header_size)||!has_compact_magic(data,size))
+      throw file_format_error(err_msg);
+    if(io::get_uint32(begin+4)!=compact_version)
+      throw file_format_error(err_msg);
+    string_count=io::get_uint32(begin+8);
+    uint32_t string_data_size=io::get_uint32(begin+12);
+    uint32_t feature_count=io::get_uint32(begin+16);
+    uint32_t answer_count=io::get_uint32(begin+20);
+    uint32_t list_size=io::get_uint32(begin+24);
+    uint32_t node_count=io::get_uint32(begin+28);
+    std::size_t padded_string_data_size=string_data_size+((4-string_data_size%4)%4);
+    std::size_t rest=size-header_size;
+    if((node_count==0)||(string_count>rest/4)||(padded_string_data_size>rest-4*string_count))
+      throw file_format_error(err_msg);
+    rest-=4*string_count+padded_string_data_size;
+    if((feature_count>rest/4)||(answer_count>rest/4-feature_count)||(list_size>rest/4-feature_count-answer_count))
+      throw file_format_error(err_msg);
+    rest-=4*(feature_count+answer_count+list_size);
+    if(rest!=node_size*static_cast<std::size_t>(node_count))
+      throw file_format_error(err_msg);
+    string_offsets=begin+header_size;
+    string_data=reinterpret_cast<const char*>(string_offsets+4*string_count);
+    if((string_count>0)&&((string_data_size==0)||(string_data[string_data_size-1]!=0)))
+      throw file_format_error(err_msg);
+    for(uint32_t i=0;i<string_count;++i)
+      {
+        if(io::get_uint32(string_offsets+4*i)>=string_data_size)
+          throw file_format_error(err_msg);
+      }
+    const unsigned char* features_begin=reinterpret_cast<const unsigned char*>(string_data)+padded_string_data_size;
+    feature_names.reserve(feature_count);
+    for(uint32_t i=0;i<feature_count;++i)
+      {
+        uint32_t id=io::get_uint32(features_begin+4*i);
+        if(id>=string_count)
+          throw file_format_error(err_msg);
+        feature_names.push_back(get_string(id));
+      }
+    const unsigned char* answers_begin=features_begin+4*feature_count;
+    answers.reserve(answer_count);
+    for(uint32_t i=0;i<answer_count;++i)
+      {
+        uint32_t code=io::get_uint32(answers_begin+4*i);
+        if(code&number_flag)
+          answers.push_back(static_cast<unsigned int>(code&~number_flag));
+        else if(code<string_count)
+          answers.push_back(std::string(get_string(code)));
+        else
+          throw file_format_error(err_msg);
+      }
+    lists=answers_begin+4*answer_count;
+    for(uint32_t i=0;i<list_size;++i)
+      {
+        uint32_t code=io::get_uint32(lists+4*i);
+        if((code==no_value)||(!(code&number_flag)&&(code>=string_count)))
+          throw file_format_error(err_msg);
+      }
+    nodes=lists+4*list_size;
+    for(uint32_t i=0;i<node_count;++i)
+      {
+        const unsigned char* n=nodes+node_size*i;
+        uint32_t type=n[0];
+        uint32_t count=io::get_uint32(n)&0xffffff;
+        uint32_t val=io::get_uint32(n+8);
+        if(type==0)
+          {
+            if(val>=answer_count)
+              throw file_format_error(err_msg);
+            continue;
+          }
+        if(io::get_uint32(n+4)>=feature_count)
+          throw file_format_error(err_msg);
+        uint32_t yes=io::get_uint32(n+12);
+        uint32_t no=io::get_uint32(n+16);
+        if((yes<=i)||(yes>=node_count)||(no<=i)||(no>=node_count))
+          throw file_format_error(err_msg);
+        switch(type)
+          {
+          case condition_equal:
+            if((val==no_value)||(!(val&number_flag)&&(val>=string_count)))
+              throw file_format_error(err_msg);
+            break;
+          case condition_less:
+          case condition_grater:
+            if((val==no_value)||!(val&number_flag))
+              throw file_format_error(err_msg);
+            break;
+          case condition_in:
+            if((count==0)||(val>list_size)||(count>list_size-val))
+              throw file_format_error(err_msg);
+            break;
+          default:
+            throw file_format_error(err_msg);
+          }
+      }
+  }
+
+  const char* dtree::compact_tree::get_string(uint32_t id) const
+  {
+    return (string_data+io::get_uint32(string_offsets+4*id));
+  }
+
+  uint32_t dtree::compact_tree::encode(const value& val) const
+  {
+    if(val.empty())
+      return number_flag;
+    if(val.is<unsigned int>())
+      {
+        unsigned int num=val.as<unsigned int>();
+        return ((num<(number_flag-1))?(number_flag|num):no_value);
+      }
+    if(!val.is<std::string>())
+      return no_value;
+    const std::string& str=val.as<std::string>();
+    if(!str.empty()&&(str.find_first_not_of("0123456789")==std::string::npos)&&((str.size()==1)||(str[0]!='0'))&&(str.size()<10))
+      {
+        uint32_t num=0;
+        for(std::string::const_iterator it=str.begin();it!=str.end();++it)
+          num=10*num+(*it-'0');
+        return ((num<(number_flag-1))?(number_flag|num):no_value);
+      }
+    uint32_t first=0;
+    uint32_t last=string_count;
+    while(first<last)
+      {
+        uint32_t middle=first+(last-first)/2;
+        int result=std::strcmp(get_string(middle),str.c_str());
+        if(result==0)
+          return middle;
+        else if(result<0)
+          first=middle+1;
+        else
+          last=middle;
+      }
+    return no_value;
+  }
+
+  bool dtree::compact_tree::test(const unsigned char* n,uint32_t code) const
+  {
+    uint32_t val=io::get_uint32(n+8);
+    switch(n[0])
+      {
+      case condition_equal:
+        return (code==val);
+      case condition_less:
+        return ((code!=no_value)&&(code&number_flag)&&(code<val));
+      case condition_grater:
+        return ((code!=no_value)&&(code&number_flag)&&(code>val));
+      default:
+        {
+          if(code==no_value)
+            return false;
+          const unsigned char* first=lists+4*val;
+          const unsigned char* last=first+4*(io::get_uint32(n)&0xffffff);
+          while(first<last)
+            {
+              const unsigned char* middle=first+4*((last-first)/8);
+              uint32_t item=io::get_uint32(middle);
+              if(item==code)
+                return true;
+              else if(item<code)
+                first=middle+4;
+              else
+                last=middle;
+            }
+          return false;
+        }
+      }
+  }
+
+  const value& dtree::compact_tree::predict(const dtree::features& f) const
+  {
+    // features tested again deeper in the tree are evaluated only once
+    std::pair<uint32_t,uint32_t> codes[max_cached_features];
+    std::size_t code_count=0;
+    const unsigned char* n=nodes;
+    while(n[0]!=0)
+      {
+        uint32_t feature=io::get_uint32(n+4);
+        std::size_t i=0;
+        while((i<code_count)&&(codes[i].first!=feature))
+          ++i;
+        uint32_t code;
+        if(i<code_count)
+          code=codes[i].second;
+        else
+          {
+            code=encode(f.eval(feature_names[feature]));
+            if(code_count<max_cached_features)
+              codes[code_count++]=std::make_pair(feature,code);
+          }
+        n=nodes+node_size*io::get_uint32(n+(test(n,code)?12:16));
+      }
+    return answers[io::get_uint32(n+8)];
+  }
+
+  dtree::dtree(const std::string& file_path)
+  {
+    mapping.reset(new io::mapped_file(file_path));
+    if(has_compact_magic(mapping->data(),mapping->size()))
+      compact.reset(new compact_tree(mapping->data(),mapping->size()));
+    else
+      {
+        mapping.reset();
+        std::ifstream f;
+        io::open_ifstream(f,file_path,true);
+        load(f);
+      }
+  }
+
+  dtree::dtree(std::istream& in)
+  {
+    // text trees start with a number and are read in place, leaving
+    // the stream right after the tree
+    if(in.peek()!=compact_magic[0])
+      {
+        load(in);
+        return;
+      }
+    buffer.assign(std::istreambuf_iterator<char>(in),std::istreambuf_iterator<char>());
+    if(has_compact_magic(buffer.empty()?0:&buffer[0],buffer.size()))
+      compact.reset(new compact_tree(&buffer[0],buffer.size()));
+    else
+      {
+        std::istringstream s(std::string(buffer.begin(),buffer.end()));
+        std::vector<char>().swap(buffer);
+        load(s);
+      }
+  }
+
   void dtree::load(std::istream& in)
   {
     unsigned int type=read_number(in);
@@ -181,6 +429,8 @@ namespace RHVoice
 
   const value& dtree::predict(const dtree::features& f) const
   {
+    if(compact.get())
+      return compact->predict(f);
     const node* cur_node=root.get();
     while(!(cur_node->is_leaf()))
       {
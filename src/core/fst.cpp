@@ -14,6 +14,9 @@
 /* along with this program.  If not, see <http://www.gnu.org/licenses/>. */
 
 #include <fstream>
+#include <sstream>
+#include <cstring>
+#include <algorithm>
 #include "core/fst.hpp"
 #include "core/exception.hpp"
 #include "core/io.hpp"
@@ -23,74 +26,214 @@ namespace RHVoice
   namespace
   {
     const std::string err_msg("Incorrect format of the fst file");
-  }
+    const char compact_magic[4]={'R','H','F','S'};
+    const uint32_t compact_version=1;
+    const std::size_t header_size=24;
+    // Symbol ids are 16 bit, and the first two are reserved
+    const uint32_t max_symbols=0xfffe;
 
-  void fst::alphabet::load(std::istream& in)
-  {
-    fst::symbol_id num_symbols;
-    if(!io::read_integer(in,num_symbols))
-      throw file_format_error(err_msg);
-    ids_to_names.clear();
-    names_to_ids.clear();
-    ids_to_names.reserve(num_symbols);
-    std::string name;
-    for(fst::symbol_id i=0;i<num_symbols;++i)
+    inline std::size_t padded(std::size_t size)
+    {
+      return (size+((4-size%4)%4));
+    }
+
+    inline bool has_compact_magic(const char* data,std::size_t size)
+    {
+      return ((size>=sizeof(compact_magic))&&(std::memcmp(data,compact_magic,sizeof(compact_magic))==0));
+    }
+
+    inline void put_uint32(std::vector<char>& out,uint32_t n)
+    {
+      out.push_back(static_cast<char>((n>>24)&0xff));
+      out.push_back(static_cast<char>((n>>16)&0xff));
+      out.push_back(static_cast<char>((n>>8)&0xff));
+      out.push_back(static_cast<char>(n&0xff));
+    }
+
+    inline void put_uint16(std::vector<char>& out,uint16_t n)
+    {
+      out.push_back(static_cast<char>((n>>8)&0xff));
+      out.push_back(static_cast<char>(n&0xff));
+    }
+
+    inline void pad(std::vector<char>& out)
+    {
+      out.resize(padded(out.size()),0);
+    }
+
+    struct compare_names
+    {
+      explicit compare_names(const std::vector<std::string>& n):
+        names(&n)
       {
-        if(!io::read_string(in,name))
-          throw file_format_error(err_msg);
-        ids_to_names.push_back(name);
-        names_to_ids[name]=i+2;
       }
+
+      bool operator()(uint16_t i,uint16_t j) const
+      {
+        return ((*names)[i]<(*names)[j]);
+      }
+
+      const std::vector<std::string>* names;
+    };
+
+    void convert_legacy(std::istream& in,std::vector<char>& out)
+    {
+      uint16_t num_symbols;
+      if(!io::read_integer(in,num_symbols)||(num_symbols>max_symbols))
+        throw file_format_error(err_msg);
+      std::vector<std::string> names(num_symbols);
+      for(uint16_t i=0;i<num_symbols;++i)
+        {
+          if(!io::read_string(in,names[i]))
+            throw file_format_error(err_msg);
+        }
+      uint32_t num_states;
+      if(!io::read_integer(in,num_states))
+        throw file_format_error(err_msg);
+      std::vector<char> finals;
+      std::vector<uint32_t> offsets(1,0);
+      std::vector<uint32_t> targets;
+      std::vector<uint16_t> isymbols,osymbols;
+      for(uint32_t i=0;i<num_states;++i)
+        {
+          uint8_t final_flag;
+          uint32_t num_arcs;
+          if(!io::read_integer(in,final_flag)||!io::read_integer(in,num_arcs))
+            throw file_format_error(err_msg);
+          finals.push_back(final_flag);
+          for(uint32_t j=0;j<num_arcs;++j)
+            {
+              uint32_t target;
+              uint16_t isymbol,osymbol;
+              io::read_integer(in,target);
+              io::read_integer(in,isymbol);
+              io::read_integer(in,osymbol);
+              if(!in)
+                throw file_format_error(err_msg);
+              targets.push_back(target);
+              isymbols.push_back(isymbol);
+              osymbols.push_back(osymbol);
+            }
+          offsets.push_back(targets.size());
+        }
+      out.clear();
+      out.insert(out.end(),compact_magic,compact_magic+sizeof(compact_magic));
+      put_uint32(out,compact_version);
+      put_uint32(out,num_symbols);
+      std::vector<uint32_t> name_offsets;
+      uint32_t data_size=0;
+      for(uint16_t i=0;i<num_symbols;++i)
+        {
+          name_offsets.push_back(data_size);
+          data_size+=names[i].size()+1;
+        }
+      put_uint32(out,data_size);
+      put_uint32(out,num_states);
+      put_uint32(out,targets.size());
+      for(uint16_t i=0;i<num_symbols;++i)
+        put_uint32(out,name_offsets[i]);
+      std::vector<uint16_t> order(num_symbols);
+      for(uint16_t i=0;i<num_symbols;++i)
+        order[i]=i;
+      std::sort(order.begin(),order.end(),compare_names(names));
+      for(uint16_t i=0;i<num_symbols;++i)
+        put_uint16(out,order[i]);
+      pad(out);
+      for(uint16_t i=0;i<num_symbols;++i)
+        {
+          out.insert(out.end(),names[i].begin(),names[i].end());
+          out.push_back(0);
+        }
+      pad(out);
+      out.insert(out.end(),finals.begin(),finals.end());
+      pad(out);
+      for(std::size_t i=0;i<offsets.size();++i)
+        put_uint32(out,offsets[i]);
+      for(std::size_t i=0;i<targets.size();++i)
+        put_uint32(out,targets[i]);
+      for(std::size_t i=0;i<isymbols.size();++i)
+        put_uint16(out,isymbols[i]);
+      for(std::size_t i=0;i<osymbols.size();++i)
+        put_uint16(out,osymbols[i]);
+    }
   }
 
-  fst::arc::arc(std::istream& in)
+  fst::fst(const std::string& path)
   {
-    io::read_integer(in,target);
-    io::read_integer(in,isymbol);
-    io::read_integer(in,osymbol);
-    if(!in)
-      throw file_format_error(err_msg);
+    mapping.reset(new io::mapped_file(path));
+    if(has_compact_magic(mapping->data(),mapping->size()))
+      attach(mapping->data(),mapping->size());
+    else
+      {
+        mapping.reset();
+        std::ifstream f;
+        io::open_ifstream(f,path,true);
+        convert_legacy(f,buffer);
+        attach(&buffer[0],buffer.size());
+      }
   }
 
-  fst::state::state(std::istream& in)
+  void fst::attach(const char* data,std::size_t size)
   {
-    uint8_t final_flag;
-    if(!io::read_integer(in,final_flag))
+    const unsigned char* begin=reinterpret_cast<const unsigned char*>(data);
+    if((size<header_size)||!has_compact_magic(data,size))
       throw file_format_error(err_msg);
-    final=final_flag;
-    uint32_t num_arcs;
-    if(!io::read_integer(in,num_arcs))
+    if(io::get_uint32(begin+4)!=compact_version)
       throw file_format_error(err_msg);
-    if(num_arcs>0)
+    uint32_t num_symbols=io::get_uint32(begin+8);
+    uint32_t symbol_data_size=io::get_uint32(begin+12);
+    num_states=io::get_uint32(begin+16);
+    uint32_t num_arcs=io::get_uint32(begin+20);
+    if(num_symbols>max_symbols)
+      throw file_format_error(err_msg);
+    std::size_t rest=size-header_size;
+    std::size_t symbols_size=4*num_symbols+padded(2*num_symbols);
+    if((symbols_size>rest)||(symbol_data_size>rest-symbols_size))
+      throw file_format_error(err_msg);
+    rest-=symbols_size+padded(symbol_data_size);
+    if((num_states>rest/5)||(padded(num_states)+4*(static_cast<std::size_t>(num_states)+1)>rest))
+      throw file_format_error(err_msg);
+    rest-=padded(num_states)+4*(static_cast<std::size_t>(num_states)+1);
+    if(rest!=8*static_cast<std::size_t>(num_arcs))
+      throw file_format_error(err_msg);
+    const unsigned char* symbol_offsets=begin+header_size;
+    const unsigned char* symbol_order=symbol_offsets+4*num_symbols;
+    const char* symbol_data=reinterpret_cast<const char*>(symbol_order+padded(2*num_symbols));
+    if((num_symbols>0)&&((symbol_data_size==0)||(symbol_data[symbol_data_size-1]!=0)))
+      throw file_format_error(err_msg);
+    for(uint32_t i=0;i<num_symbols;++i)
       {
-        arcs.reserve(num_arcs);
-        for(uint32_t i=0;i<num_arcs;++i)
-          {
-            arcs.push_back(arc(in));
-          }
+        if((io::get_uint32(symbol_offsets+4*i)>=symbol_data_size)||(io::get_uint16(symbol_order+2*i)>=num_symbols))
+          throw file_format_error(err_msg);
       }
-  }
-
-  fst::fst(const std::string& path)
-  {
-    std::ifstream f;
-    io::open_ifstream(f,path,true);
-    symbols.load(f);
-    state_id num_states;
-    if(!io::read_integer(f,num_states))
+    symbols.attach(num_symbols,symbol_offsets,symbol_order,symbol_data);
+    finals=reinterpret_cast<const unsigned char*>(symbol_data)+padded(symbol_data_size);
+    state_offsets=finals+padded(num_states);
+    targets=state_offsets+4*(num_states+1);
+    isymbols=targets+4*num_arcs;
+    osymbols=isymbols+2*num_arcs;
+    uint32_t previous=0;
+    for(uint32_t i=0;i<=num_states;++i)
+      {
+        uint32_t offset=io::get_uint32(state_offsets+4*i);
+        if((offset<previous)||(offset>num_arcs)||((i==0)&&(offset!=0)))
+          throw file_format_error(err_msg);
+        previous=offset;
+      }
+    if(previous!=num_arcs)
       throw file_format_error(err_msg);
-    states.reserve(num_states);
-    for(state_id i=0;i<num_states;++i)
+    for(uint32_t i=0;i<num_arcs;++i)
       {
-        states.push_back(state(f));
+        if(io::get_uint32(targets+4*i)>=num_states)
+          throw file_format_error(err_msg);
       }
   }
 
   std::string fst::alphabet::name(symbol_id id) const
   {
-    if((id<2)||(id>=(ids_to_names.size()+2)))
+    if((id<2)||(id>=(size+2)))
       throw symbol_not_found();
-    return ids_to_names[id-2];
+    return get(id-2);
   }
 
   std::string fst::alphabet::name(symbol_id id,const std::string& default_name) const
@@ -107,37 +250,71 @@ namespace RHVoice
 
   fst::symbol_id fst::alphabet::id(const std::string& name) const
   {
-    symbol_map::const_iterator it=names_to_ids.find(name);
-    if(it==names_to_ids.end())
-      throw symbol_not_found();
-    return it->second;
+    uint32_t first=0;
+    uint32_t last=size;
+    while(first<last)
+      {
+        uint32_t middle=first+(last-first)/2;
+        uint16_t index=io::get_uint16(order+2*middle);
+        int result=std::strcmp(get(index),name.c_str());
+        if(result==0)
+          return (index+2);
+        else if(result<0)
+          first=middle+1;
+        else
+          last=middle;
+      }
+    throw symbol_not_found();
   }
 
   fst::symbol_id fst::alphabet::id(const std::string& name,fst::symbol_id default_id) const
   {
-    symbol_map::const_iterator it=names_to_ids.find(name);
-    return ((it==names_to_ids.end())?default_id:(it->second));
+    try
+      {
+        return id(name);
+      }
+    catch(const lookup_error&)
+      {
+        return default_id;
+      }
+  }
+
+  fst::arc_index fst::find_arc(state_id s,symbol_id id) const
+  {
+    arc_index first=arcs_begin(s);
+    arc_index last=arcs_end(s);
+    arc_index end=last;
+    while(first<last)
+      {
+        arc_index middle=first+(last-first)/2;
+        if(input_symbol(middle)<id)
+          first=middle+1;
+        else
+          last=middle;
+      }
+    return (((first!=end)&&(input_symbol(first)==id))?first:end);
   }
 
   void fst::arc_filter::next()
   {
-    if(current_arc==source_state->end())
+    arc_index end=owner->arcs_end(source_state);
+    if(current_arc==end)
       return;
-    symbol_id symbol=current_arc->isymbol;
+    symbol_id symbol=owner->input_symbol(current_arc);
     ++current_arc;
-    if(current_arc==source_state->end())
+    if(current_arc==end)
       {
         if(symbol!=0)
-          current_arc=source_state->find_arc(0);
+          current_arc=owner->find_arc(source_state,0);
       }
     else
       {
-        if(current_arc->isymbol!=symbol)
+        if(owner->input_symbol(current_arc)!=symbol)
           {
             if(symbol==0)
-              current_arc=source_state->end();
+              current_arc=end;
             else
-              current_arc=source_state->find_arc(0);
+              current_arc=owner->find_arc(source_state,0);
           }
       }
   }
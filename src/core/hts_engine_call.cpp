@@ -18,6 +18,7 @@
 #include <algorithm>
 #include <queue>
 #include <cmath>
+#include <limits>
 #include "sonic.h"
 #include "core/language.hpp"
 #include "core/voice.hpp"
@@ -39,7 +40,10 @@ namespace RHVoice
 
       std::size_t get_desired_input_size() const
       {
-        return (player->get_audio_buffer_size()/1000.0*sample_rate);
+        unsigned int size=player->get_audio_buffer_size();
+        if(size==0)
+          return std::numeric_limits<std::size_t>::max();
+        return (size/1000.0*sample_rate);
       }
 
       std::vector<short> samples;
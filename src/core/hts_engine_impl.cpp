@@ -167,7 +167,10 @@ namespace RHVoice
   void hts_engine_impl::on_new_sample(short sample)
   {
     if(output->is_stopped())
-      return;
+      {
+        do_stop();
+        return;
+      }
     double s=(sample/32768.0)*gain;
     try
       {
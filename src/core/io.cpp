@@ -15,6 +15,12 @@
 
 #ifdef WIN32
 #include <wchar.h>
+#else
+#include <sys/types.h>
+#include <sys/stat.h>
+#include <sys/mman.h>
+#include <fcntl.h>
+#include <unistd.h>
 #endif
 #include "core/io.hpp"
 #include "utf8.h"
@@ -53,5 +59,79 @@ namespace RHVoice
       if(!stream.is_open())
         throw open_error();
     }
+
+    #ifdef WIN32
+    mapped_file::mapped_file(const std::string& path):
+      start(0),
+      length(0),
+      file_handle(INVALID_HANDLE_VALUE),
+      mapping_handle(0)
+    {
+      std::wstring wpath;
+      utf8::utf8to16(path.begin(),path.end(),std::back_inserter(wpath));
+      file_handle=CreateFileW(wpath.c_str(),GENERIC_READ,FILE_SHARE_READ,0,OPEN_EXISTING,FILE_ATTRIBUTE_NORMAL,0);
+      if(file_handle==INVALID_HANDLE_VALUE)
+        throw open_error();
+      LARGE_INTEGER file_size;
+      if(!GetFileSizeEx(file_handle,&file_size))
+        {
+          CloseHandle(file_handle);
+          throw open_error();
+        }
+      length=static_cast<std::size_t>(file_size.QuadPart);
+      if(length==0)
+        return;
+      mapping_handle=CreateFileMappingW(file_handle,0,PAGE_READONLY,0,0,0);
+      if(mapping_handle!=0)
+        start=static_cast<const char*>(MapViewOfFile(mapping_handle,FILE_MAP_READ,0,0,0));
+      if(start==0)
+        {
+          if(mapping_handle!=0)
+            CloseHandle(mapping_handle);
+          CloseHandle(file_handle);
+          throw open_error();
+        }
+    }
+
+    mapped_file::~mapped_file()
+    {
+      if(start!=0)
+        UnmapViewOfFile(start);
+      if(mapping_handle!=0)
+        CloseHandle(mapping_handle);
+      CloseHandle(file_handle);
+    }
+    #else
+    mapped_file::mapped_file(const std::string& path):
+      start(0),
+      length(0)
+    {
+      int fd=open(path.c_str(),O_RDONLY);
+      if(fd<0)
+        throw open_error();
+      struct stat info;
+      if(fstat(fd,&info)!=0)
+        {
+          close(fd);
+          throw open_error();
+        }
+      length=info.st_size;
+      if(length!=0)
+        {
+          void* addr=mmap(0,length,PROT_READ,MAP_SHARED,fd,0);
+          if(addr!=MAP_FAILED)
+            start=static_cast<const char*>(addr);
+        }
+      close(fd);
+      if((length!=0)&&(start==0))
+        throw open_error();
+    }
+
+    mapped_file::~mapped_file()
+    {
+      if(start!=0)
+        munmap(const_cast<char*>(start),length);
+    }
+    #endif
   }
 }
@@ -85,12 +85,21 @@ namespace RHVoice
       throw synthesis_error();
     set_time_info();
     set_pitch();
+    if(output->is_stopped())
+      return;
     if(!HTS_Engine_create_pstream(engine.get()))
       throw synthesis_error();
+    if(output->is_stopped())
+      return;
     if(!HTS_Engine_create_gstream(engine.get()))
       throw synthesis_error();
   }
 
+  void std_hts_engine_impl::do_stop()
+  {
+    HTS_Engine_set_stop_flag(engine.get(),true);
+  }
+
   void std_hts_engine_impl::do_reset()
   {
     HTS_Engine_set_stop_flag(engine.get(),false);
@@ -43,6 +43,8 @@ typedef struct
 } RHVoice_callbacks;
 
   typedef enum {
+    /* Load data of every language and voice when the engine is created, */
+    /* instead of on their first use. */
     RHVoice_preload_voices=1
   } RHVoice_init_option;
   typedef unsigned int RHVoice_init_options;
@@ -115,6 +117,13 @@ typedef struct
   RHVoice_tts_engine RHVoice_new_tts_engine(const RHVoice_init_params* init_params);
   void RHVoice_delete_tts_engine(RHVoice_tts_engine tts_engine);
 
+  /* How much speech is passed to play_speech at once, 100 ms by default. */
+  /* 0 means a whole sentence. Larger blocks mean fewer calls, */
+  /* but the first one comes later, and events are reported */
+  /* before the audio they precede by up to that much. */
+  /* Applies to messages created after the call. */
+  void RHVoice_set_audio_buffer_size(RHVoice_tts_engine tts_engine,unsigned int milliseconds);
+
   unsigned int RHVoice_get_number_of_voices(RHVoice_tts_engine tts_engine);
   const RHVoice_voice_info* RHVoice_get_voices(RHVoice_tts_engine tts_engine);
   unsigned int RHVoice_get_number_of_voice_profiles(RHVoice_tts_engine tts_engine);
@@ -132,6 +141,10 @@ typedef struct
 
   int RHVoice_speak(RHVoice_message message);
 
+  /* Makes RHVoice_speak of the message return as soon as possible. */
+  /* It may be called from any thread while the message is being spoken. */
+  void RHVoice_cancel(RHVoice_message message);
+
 #ifdef __cplusplus
 }
 #endif
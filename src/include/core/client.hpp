@@ -38,7 +38,7 @@ namespace RHVoice
     {
     }
 
-    virtual unsigned int get_audio_buffer_size() const // in milliseconds
+    virtual unsigned int get_audio_buffer_size() const // in milliseconds, 0 means whole sentence
     {
       return 100;
     }
@@ -93,6 +93,12 @@ namespace RHVoice
       return true;
     }
 
+    // Checked between sentences and synthesis stages, may be set from another thread
+    virtual bool is_cancelled() const
+    {
+      return false;
+    }
+
   protected:
     client()
     {
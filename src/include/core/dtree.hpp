@@ -229,7 +229,33 @@ namespace RHVoice
       std::auto_ptr<node> yes_node,no_node;
     };
 
+    class compact_tree
+    {
+    public:
+      compact_tree(const char* data,std::size_t size);
+      const value& predict(const features& f) const;
+
+    private:
+      compact_tree(const compact_tree&);
+      compact_tree& operator=(const compact_tree&);
+
+      const char* get_string(uint32_t id) const;
+      uint32_t encode(const value& val) const;
+      bool test(const unsigned char* n,uint32_t code) const;
+
+      uint32_t string_count;
+      const unsigned char* string_offsets;
+      const char* string_data;
+      const unsigned char* lists;
+      const unsigned char* nodes;
+      std::vector<std::string> feature_names;
+      std::vector<value> answers;
+    };
+
     std::auto_ptr<node> root;
+    std::auto_ptr<io::mapped_file> mapping;
+    std::vector<char> buffer;
+    std::auto_ptr<compact_tree> compact;
 
     dtree(const dtree&);
     dtree& operator=(const dtree&);
@@ -238,17 +264,8 @@ namespace RHVoice
     void load(std::istream& in);
 
   public:
-    explicit dtree(const std::string& file_path)
-    {
-      std::ifstream f;
-      io::open_ifstream(f,file_path,true);
-      load(f);
-    }
-
-    explicit dtree(std::istream& in)
-    {
-      load(in);
-    }
+    explicit dtree(const std::string& file_path);
+    explicit dtree(std::istream& in);
 
     const value& predict(const item& i) const
     {
@@ -25,8 +25,10 @@
 #include <iterator>
 #include <algorithm>
 #include <functional>
+#include <memory>
 #include "utf8.h"
 #include "exception.hpp"
+#include "io.hpp"
 #include "item.hpp"
 
 namespace RHVoice
@@ -40,6 +42,9 @@ namespace RHVoice
     typedef uint32_t state_id;
     typedef uint16_t symbol_id;
 
+    fst(const fst&);
+    fst& operator=(const fst&);
+
     class symbol_not_found: public lookup_error
     {
     public:
@@ -52,15 +57,36 @@ namespace RHVoice
     class alphabet
     {
     public:
-      void load(std::istream& in);
+      alphabet():
+        size(0),
+        offsets(0),
+        order(0),
+        data(0)
+      {
+      }
+
+      void attach(uint32_t count,const unsigned char* offsets_start,const unsigned char* order_start,const char* data_start)
+      {
+        size=count;
+        offsets=offsets_start;
+        order=order_start;
+        data=data_start;
+      }
+
       std::string name(symbol_id id) const;
       std::string name(symbol_id id,const std::string& default_name) const;
       symbol_id id(const std::string& name) const;
       symbol_id id(const std::string& name,symbol_id default_id) const;
     private:
-      typedef std::map<std::string,symbol_id> symbol_map;
-      std::vector<std::string> ids_to_names;
-      symbol_map names_to_ids;
+      const char* get(uint32_t index) const
+      {
+        return (data+io::get_uint32(offsets+4*index));
+      }
+
+      uint32_t size;
+      const unsigned char* offsets;
+      const unsigned char* order;
+      const char* data;
     };
 
     struct arc
@@ -80,89 +106,78 @@ namespace RHVoice
         osymbol(o)
       {
       }
-
-      explicit arc(std::istream& in);
     };
 
-    class state
-    {
-    private:
-      struct compare_arcs: public std::binary_function<bool,const arc&,const arc&>
-      {
-        bool operator()(const arc& arc1,const arc& arc2) const
-        {
-          return (arc1.isymbol<arc2.isymbol);
-        }
-      };
-
-    public:
-      explicit state(std::istream& in);
+    typedef uint32_t arc_index;
 
-      bool is_final() const
-      {
-        return final;
-      }
+    std::auto_ptr<io::mapped_file> mapping;
+    std::vector<char> buffer;
+    alphabet symbols;
+    uint32_t num_states;
+    const unsigned char* finals;
+    const unsigned char* state_offsets;
+    const unsigned char* targets;
+    const unsigned char* isymbols;
+    const unsigned char* osymbols;
 
-      state():
-        final(false)
-      {
-      }
+    void attach(const char* data,std::size_t size);
 
-      typedef std::vector<arc>::const_iterator arc_iterator;
+    bool is_final(state_id s) const
+    {
+      return (finals[s]!=0);
+    }
 
-      arc_iterator begin() const
-      {
-        return arcs.begin();
-      }
+    arc_index arcs_begin(state_id s) const
+    {
+      return io::get_uint32(state_offsets+4*s);
+    }
 
-      arc_iterator find_arc(symbol_id id) const
-      {
-        arc_iterator it=std::lower_bound(arcs.begin(),arcs.end(),arc(0,id,0),compare_arcs());
-        return (((it!=arcs.end())&&(it->isymbol==id))?it:arcs.end());
-      }
+    arc_index arcs_end(state_id s) const
+    {
+      return io::get_uint32(state_offsets+4*(s+1));
+    }
 
-      arc_iterator end() const
-      {
-        return arcs.end();
-      }
-    private:
-      bool final;
-      std::vector<arc> arcs;
-    };
+    symbol_id input_symbol(arc_index a) const
+    {
+      return io::get_uint16(isymbols+2*a);
+    }
 
-    typedef state::arc_iterator arc_iterator;
+    arc get_arc(arc_index a) const
+    {
+      return arc(io::get_uint32(targets+4*a),io::get_uint16(isymbols+2*a),io::get_uint16(osymbols+2*a));
+    }
 
-    std::vector<state> states;
-    alphabet symbols;
+    arc_index find_arc(state_id s,symbol_id id) const;
 
-    typedef std::vector<state>::const_iterator state_iterator;
     typedef std::vector<std::pair<std::string,symbol_id> > input_symbols;
 
     class arc_filter
     {
     public:
-      arc_filter(state_iterator sstate,symbol_id isymbol):
+      arc_filter(const fst& f,state_id sstate,symbol_id isymbol):
+        owner(&f),
         source_state(sstate),
-        current_arc(source_state->find_arc(isymbol))
+        current_arc(f.find_arc(sstate,isymbol))
       {
-        if(current_arc==source_state->end())
-          current_arc=source_state->find_arc(0);
+        if(current_arc==owner->arcs_end(source_state))
+          current_arc=owner->find_arc(source_state,0);
       }
 
-      const arc& get() const
+      arc get() const
       {
-        return *current_arc;
+        return owner->get_arc(current_arc);
       }
 
       void next();
 
       bool done() const
       {
-        return (current_arc==source_state->end());
+        return (current_arc==owner->arcs_end(source_state));
       }
     private:
-      state_iterator source_state;
-      arc_iterator current_arc;
+      const fst* owner;
+      state_id source_state;
+      arc_index current_arc;
     };
 
     template<class output_iterator> bool do_translate(const input_symbols& input,output_iterator output) const;
@@ -190,12 +205,12 @@ namespace RHVoice
   template<class output_iterator>
   bool fst::do_translate(const input_symbols& input,output_iterator output) const
   {
-    if(states.empty())
+    if(num_states==0)
       return false;
     input_symbols::const_iterator pos=input.begin();
     if(pos==input.end())
       return false;
-    arc_filter f(states.begin(),pos->second);
+    arc_filter f(*this,0,pos->second);
     if(f.done())
       return false;
     std::vector<arc_filter> path;
@@ -206,13 +221,13 @@ namespace RHVoice
       {
         if(pos==input.end())
           {
-            if(states[path.back().get().target].is_final())
+            if(is_final(path.back().get().target))
               break;
             else
-              f=arc_filter(states.begin()+path.back().get().target,0);
+              f=arc_filter(*this,path.back().get().target,0);
           }
         else
-          f=arc_filter(states.begin()+path.back().get().target,pos->second);
+          f=arc_filter(*this,path.back().get().target,pos->second);
         if(f.done())
           {
             while(!path.empty())
@@ -237,7 +252,7 @@ namespace RHVoice
               ++pos;
           }
       }
-    if((pos!=input.end())||path.empty()||(!states[path.back().get().target].is_final()))
+    if((pos!=input.end())||path.empty()||(!is_final(path.back().get().target)))
       return false;
     pos=input.begin();
     for(std::vector<arc_filter>::const_iterator it=path.begin();it!=path.end();++it)
@@ -141,6 +141,11 @@ namespace RHVoice
     virtual void do_synthesize()=0;
     virtual void do_reset()=0;
 
+    // Called when output has been stopped, engines which can should stop generating samples
+    virtual void do_stop()
+    {
+    }
+
     std::string name;
   };
 }
@@ -45,6 +45,34 @@ namespace RHVoice
     file_handle open_file(const std::string& path,const std::string& mode);
     void open_ifstream(std::ifstream& stream,const std::string& path,bool binary=false);
 
+    class mapped_file
+    {
+    public:
+      explicit mapped_file(const std::string& path);
+      ~mapped_file();
+
+      const char* data() const
+      {
+        return start;
+      }
+
+      std::size_t size() const
+      {
+        return length;
+      }
+
+    private:
+      mapped_file(const mapped_file&);
+      mapped_file& operator=(const mapped_file&);
+
+      const char* start;
+      std::size_t length;
+      #ifdef WIN32
+      HANDLE file_handle;
+      HANDLE mapping_handle;
+      #endif
+    };
+
     union host_endianness
     {
       int i;
@@ -66,6 +94,16 @@ namespace RHVoice
       }
     };
 
+    inline uint32_t get_uint32(const unsigned char* p)
+    {
+      return ((static_cast<uint32_t>(p[0])<<24)|(static_cast<uint32_t>(p[1])<<16)|(static_cast<uint32_t>(p[2])<<8)|static_cast<uint32_t>(p[3]));
+    }
+
+    inline uint16_t get_uint16(const unsigned char* p)
+    {
+      return static_cast<uint16_t>((p[0]<<8)|p[1]);
+    }
+
     template<typename T>
     inline std::istream& read_integer(std::istream& in,T& out)
     {
@@ -24,6 +24,7 @@
 #include <stdexcept>
 #include <fstream>
 #include <memory>
+#include <cstring>
 #include "io.hpp"
 #include "exception.hpp"
 
@@ -92,6 +93,42 @@ namespace RHVoice
 
     std::vector<state> states;
     bool built;
+    std::auto_ptr<io::mapped_file> mapping;
+    uint32_t num_symbols,num_slots;
+    const unsigned char* alphabet;
+    const unsigned char* base;
+    const unsigned char* check;
+    const unsigned char* fail_links;
+    const unsigned char* next_links;
+    const unsigned char* values;
+    const unsigned char* key_lengths;
+
+    void attach(const std::string& err_msg);
+
+    uint32_t get_fail(uint32_t s) const
+    {
+      return (mapping.get()?io::get_uint32(fail_links+4*s):states[s].fail);
+    }
+
+    uint32_t get_next(uint32_t s) const
+    {
+      return (mapping.get()?io::get_uint32(next_links+4*s):states[s].next);
+    }
+
+    uint8_t get_key_length(uint32_t s) const
+    {
+      if(mapping.get())
+        return key_lengths[s];
+      else
+        return (states[s].data?states[s].data->key_length:0);
+    }
+
+    T get_value(uint32_t s) const
+    {
+      return (mapping.get()?static_cast<T>(io::get_uint32(values+4*s)):states[s].data->value);
+    }
+
+    bool go_to_slot(uint32_t& s,uint32_t c) const;
 
   public:
     rules():
@@ -120,11 +157,13 @@ namespace RHVoice
       struct submatch
       {
         std::size_t pos;
-        const record* data;
+        uint8_t key_length;
+        T value;
 
-        submatch(std::size_t p,const record* d):
+        submatch(std::size_t p,uint8_t len,const T& val):
           pos(p),
-          data(d)
+          key_length(len),
+          value(val)
         {
         }
       };
@@ -151,12 +190,12 @@ namespace RHVoice
 
       uint8_t length(std::size_t i) const
       {
-        return submatches.at(i).data->key_length;
+        return submatches.at(i).key_length;
       }
 
       const T& value(std::size_t i) const
       {
-        return submatches.at(i).data->value;
+        return submatches.at(i).value;
       }
     };
 
@@ -166,6 +205,8 @@ namespace RHVoice
 
     bool go_to(uint32_t& s,uint32_t c) const
     {
+      if(mapping.get())
+        return go_to_slot(s,c);
       const std::vector<arc>& arcs=states[s].arcs;
       arc a(c);
       #ifdef _MSC_VER
@@ -185,11 +226,20 @@ namespace RHVoice
   };
 
   template<typename T> template<typename R>
-  rules<T>::rules(const std::string& file_path,R reader)
+  rules<T>::rules(const std::string& file_path,R reader):
+    built(false)
   {
+    std::string err_msg("Error while loading an Aho-Corasick automaton from a file");
+    mapping.reset(new io::mapped_file(file_path));
+    if((mapping->size()>=4)&&(std::memcmp(mapping->data(),"RHAC",4)==0))
+      {
+        attach(err_msg);
+        built=true;
+        return;
+      }
+    mapping.reset();
     std::ifstream f;
     io::open_ifstream(f,file_path,true);
-    std::string err_msg("Error while loading an Aho-Corasick automaton from a file");
     uint32_t num_states=0;
     io::read_integer(f,num_states);
     if(num_states==0)
@@ -226,6 +276,66 @@ namespace RHVoice
     built=true;
   }
 
+  template<typename T>
+  void rules<T>::attach(const std::string& err_msg)
+  {
+    const unsigned char* begin=reinterpret_cast<const unsigned char*>(mapping->data());
+    std::size_t size=mapping->size();
+    if((size<16)||(io::get_uint32(begin+4)!=1))
+      throw file_format_error(err_msg);
+    num_symbols=io::get_uint32(begin+8);
+    num_slots=io::get_uint32(begin+12);
+    std::size_t rest=size-16;
+    if((num_slots==0)||(num_symbols>rest/4)||(num_slots>rest/21)||(rest!=4*static_cast<std::size_t>(num_symbols)+21*static_cast<std::size_t>(num_slots)+((4-num_slots%4)%4)))
+      throw file_format_error(err_msg);
+    alphabet=begin+16;
+    base=alphabet+4*num_symbols;
+    check=base+4*num_slots;
+    fail_links=check+4*num_slots;
+    next_links=fail_links+4*num_slots;
+    values=next_links+4*num_slots;
+    key_lengths=values+4*num_slots;
+    for(uint32_t i=1;i<num_symbols;++i)
+      {
+        if(io::get_uint32(alphabet+4*(i-1))>=io::get_uint32(alphabet+4*i))
+          throw file_format_error(err_msg);
+      }
+    for(uint32_t s=0;s<num_slots;++s)
+      {
+        uint32_t parent=io::get_uint32(check+4*s);
+        uint32_t next=get_next(s);
+        if(((parent>=num_slots)&&(parent!=0xffffffff))||(get_fail(s)>=num_slots)||(next>=num_slots)||((next!=0)&&(key_lengths[next]==0)))
+          throw file_format_error(err_msg);
+      }
+  }
+
+  template<typename T>
+  bool rules<T>::go_to_slot(uint32_t& s,uint32_t c) const
+  {
+    uint32_t first=0;
+    uint32_t last=num_symbols;
+    while(first<last)
+      {
+        uint32_t middle=first+(last-first)/2;
+        uint32_t symbol=io::get_uint32(alphabet+4*middle);
+        if(symbol==c)
+          {
+            uint32_t t=io::get_uint32(base+4*s)+middle+1;
+            if((t<num_slots)&&(io::get_uint32(check+4*t)==s))
+              {
+                s=t;
+                return true;
+              }
+            break;
+          }
+        else if(symbol<c)
+          first=middle+1;
+        else
+          last=middle;
+      }
+    return (s==0);
+  }
+
   template<typename T> template<typename input_iterator>
   void rules<T>::add(input_iterator first,input_iterator last,const T& value)
   {
@@ -233,6 +343,8 @@ namespace RHVoice
       throw std::invalid_argument("The input is empty");
     if(built)
       throw std::logic_error("All the strings should be added before building the fsm");
+    if(mapping.get())
+      throw std::logic_error("The fsm is read-only");
     arc a;
     uint32_t s=0;
     std::vector<uint32_t> chars(first,last);
@@ -319,39 +431,40 @@ namespace RHVoice
       throw std::invalid_argument("Empty input");
     if(!dict.built)
       throw std::logic_error("The fsm should be built before matching");
-    const std::vector<state>& states=dict.states;
     std::vector<uint32_t> chars(first,last);
-    std::vector<const record*> results(chars.size(),0);
+    std::vector<uint32_t> results(chars.size(),0);
     uint32_t s=0;
     uint32_t o;
     uint32_t c;
-    const record* d;
+    uint8_t len;
     for(std::size_t i=0;i<chars.size();++i)
       {
         c=chars[i];
         while(!dict.go_to(s,c))
           {
-            s=states[s].fail;
+            s=dict.get_fail(s);
           }
-        if(states[s].data)
+        if(dict.get_key_length(s)!=0)
           o=s;
         else
-          o=states[s].next;
+          o=dict.get_next(s);
         while(o!=0)
           {
-            d=states[o].data;
-            results[i+1-d->key_length]=d;
-            o=states[o].next;
+            len=dict.get_key_length(o);
+            if(len<=i+1)
+              results[i+1-len]=o;
+            o=dict.get_next(o);
           }
       }
     std::size_t i=0;
     while(i<results.size())
       {
-        d=results[i];
-        if(d)
+        o=results[i];
+        if(o!=0)
           {
-            submatches.push_back(submatch(i,d));
-            i+=d->key_length;
+            len=dict.get_key_length(o);
+            submatches.push_back(submatch(i,len,dict.get_value(o)));
+            i+=len;
           }
         else
           ++i;
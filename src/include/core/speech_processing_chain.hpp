@@ -54,7 +54,7 @@ namespace RHVoice
 
     bool is_stopped() const
     {
-      return stopped;
+      return (stopped||(player&&player->is_cancelled()));
     }
 
     void append(speech_processor* p)
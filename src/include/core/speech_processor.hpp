@@ -107,7 +107,7 @@ namespace RHVoice
 
     bool is_stopped() const
     {
-      return (stopped&&*stopped);
+      return ((stopped&&*stopped)||(player&&player->is_cancelled()));
     }
 
     void stop()
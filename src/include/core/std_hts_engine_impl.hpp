@@ -34,6 +34,7 @@ namespace RHVoice
     void do_initialize();
     void do_reset();
     void do_synthesize();
+    void do_stop();
     void load_labels();
     void set_time_info();
     void set_pitch();
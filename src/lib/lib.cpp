@@ -34,7 +34,12 @@ int LOGGING = 0;
 struct RHVoice_message_struct: public client
 {
   template<typename ch>
-  RHVoice_message_struct(const smart_ptr<engine>& engine_ptr,const RHVoice_callbacks& callbacks_,const ch* text,unsigned int length,RHVoice_message_type message_type,const RHVoice_synth_params* synth_params,void* user_data_);
+  RHVoice_message_struct(const smart_ptr<engine>& engine_ptr,const RHVoice_callbacks& callbacks_,const ch* text,unsigned int length,RHVoice_message_type message_type,const RHVoice_synth_params* synth_params,void* user_data_,unsigned int audio_buffer_size_);
+
+  unsigned int get_audio_buffer_size() const
+  {
+    return audio_buffer_size;
+  }
 
   bool play_speech(const short* samples,std::size_t count)
   {
@@ -78,6 +83,16 @@ struct RHVoice_message_struct: public client
     doc_ptr->synthesize();
   }
 
+  void cancel()
+  {
+    cancelled=1;
+  }
+
+  bool is_cancelled() const
+  {
+    return cancelled;
+  }
+
 private:
   RHVoice_message_struct(const RHVoice_message_struct&);
   RHVoice_message_struct& operator=(const RHVoice_message_struct&);
@@ -85,6 +100,8 @@ private:
   std::auto_ptr<document> doc_ptr;
   RHVoice_callbacks callbacks;
   void* user_data;
+  unsigned int audio_buffer_size;
+  volatile int cancelled;
 };
 
 struct RHVoice_tts_engine_struct
@@ -116,13 +133,20 @@ struct RHVoice_tts_engine_struct
   template<typename ch>
   RHVoice_message new_message(const ch* text,unsigned int length,RHVoice_message_type message_type,const RHVoice_synth_params* synth_params,void* user_data) const
   {
-    return (new RHVoice_message_struct(engine_ptr,callbacks,text,length,message_type,synth_params,user_data));
+    return (new RHVoice_message_struct(engine_ptr,callbacks,text,length,message_type,synth_params,user_data,audio_buffer_size));
+  }
+
+  void set_audio_buffer_size(unsigned int milliseconds)
+  {
+    audio_buffer_size=milliseconds;
   }
 
 private:
   RHVoice_tts_engine_struct(const RHVoice_tts_engine_struct&);
   RHVoice_tts_engine_struct& operator=(const RHVoice_tts_engine_struct&);
 
+  void preload_voices() const;
+
   struct convert_voice_info: public std::unary_function<const voice_info&,RHVoice_voice_info>
   {
     RHVoice_voice_info operator()(const voice_info& info) const;
@@ -138,11 +162,13 @@ private:
 
   smart_ptr<engine> engine_ptr;
   RHVoice_callbacks callbacks;
+  unsigned int audio_buffer_size;
   std::vector<RHVoice_voice_info> voice_info_array;
   std::vector<const char*> voice_profile_names_array;
 };
 
-RHVoice_tts_engine_struct::RHVoice_tts_engine_struct(const RHVoice_init_params* init_params)
+RHVoice_tts_engine_struct::RHVoice_tts_engine_struct(const RHVoice_init_params* init_params):
+  audio_buffer_size(100)
 {
   if(!init_params)
     throw std::invalid_argument("No initialization parameters provided");
@@ -169,6 +195,18 @@ RHVoice_tts_engine_struct::RHVoice_tts_engine_struct(const RHVoice_init_params*
   const std::set<voice_profile>& profiles=engine_ptr->get_voice_profiles();
   std::transform(profiles.begin(),profiles.end(),std::back_inserter(voice_profile_names_array),get_voice_profile_name());
   callbacks=init_params->callbacks;
+  if(init_params->options&RHVoice_preload_voices)
+    preload_voices();
+}
+
+void RHVoice_tts_engine_struct::preload_voices() const
+{
+  const voice_list& voices=engine_ptr->get_voices();
+  for(voice_list::const_iterator it=voices.begin();it!=voices.end();++it)
+    {
+      it->get_language()->get_instance();
+      it->get_instance();
+    }
 }
 
 RHVoice_voice_info RHVoice_tts_engine_struct::convert_voice_info::operator()(const voice_info& info) const
@@ -199,9 +237,11 @@ bool RHVoice_tts_engine_struct::are_languages_compatible(const char* language1,c
 }
 
 template<typename ch>
-RHVoice_message_struct::RHVoice_message_struct(const smart_ptr<engine>& engine_ptr,const RHVoice_callbacks& callbacks_,const ch* text,unsigned int length,RHVoice_message_type message_type,const RHVoice_synth_params* synth_params,void* user_data_):
+RHVoice_message_struct::RHVoice_message_struct(const smart_ptr<engine>& engine_ptr,const RHVoice_callbacks& callbacks_,const ch* text,unsigned int length,RHVoice_message_type message_type,const RHVoice_synth_params* synth_params,void* user_data_,unsigned int audio_buffer_size_):
   callbacks(callbacks_),
-  user_data(user_data_)
+  user_data(user_data_),
+  audio_buffer_size(audio_buffer_size_),
+  cancelled(0)
 {
   if(!text)
     throw std::invalid_argument("Text is a null pointer");
@@ -290,6 +330,12 @@ void RHVoice_delete_tts_engine(RHVoice_tts_engine tts_engine)
   delete tts_engine;
 }
 
+void RHVoice_set_audio_buffer_size(RHVoice_tts_engine tts_engine,unsigned int milliseconds)
+{
+  if(tts_engine)
+    tts_engine->set_audio_buffer_size(milliseconds);
+}
+
 unsigned int RHVoice_get_number_of_voices(RHVoice_tts_engine tts_engine)
 {
   return(tts_engine?(tts_engine->get_number_of_voices()):0);
@@ -370,3 +416,9 @@ int RHVoice_speak(RHVoice_message message)
       return 0;
     }
 }
+
+void RHVoice_cancel(RHVoice_message message)
+{
+  if(message)
+    message->cancel();
+}
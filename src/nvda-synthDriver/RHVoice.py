@@ -23,16 +23,34 @@ __version__ = "0.5.1.6"
 #                          tested with this module
 #                   ^^  -- RHVoice.py module version
 
+import collections
+import contextlib
+import hashlib
+import itertools
+import json
 import os
+import shutil
+import struct
 import sys
+import threading
 import time
 import wave
+try:
+    import Queue
+except ImportError:  # Python 3
+    import queue as Queue
 
 from ctypes import CDLL, CFUNCTYPE, POINTER, Structure, c_char_p, c_double
-from ctypes import c_int, c_uint, c_short, c_void_p, byref, sizeof, string_at
+from ctypes import c_int, c_uint, c_short, c_void_p, c_uint64, byref, sizeof
+from ctypes import c_char, addressof, memmove, string_at, cast
 
 DEBUG=0
 
+try:
+    clock = time.perf_counter
+except AttributeError:  # Python 2
+    clock = time.clock
+
 # --- workarounds for Python misbehavior ---
 
 # enable passing unicode argument from command line
@@ -124,6 +142,9 @@ class RHVoice_synth_params(Structure):
               ("punctuation_list",c_char_p),
               ("capitals_mode",c_int)]
 
+class RHVoice_init_option:
+    preload_voices=1
+
 class RHVoice_message_type:
     text=0
     ssml=1
@@ -149,8 +170,26 @@ class RHVoice_capitals_mode:
 
 # --- main code ---
 
+def get_module_dir():
+    root = __file__
+    if isinstance(root, bytes):
+        root = root.decode(sys.getfilesystemencoding())
+    return os.path.dirname(root)
+
+def to_bytes(text):
+    """ Library expects strings and paths encoded as UTF-8 """
+    if text is None or isinstance(text, bytes):
+        return text
+    return text.encode("utf-8")
+
+def to_text(text):
+    """ Decodes UTF-8 strings returned by the library """
+    if isinstance(text, bytes):
+        return text.decode("utf-8")
+    return text
+
 def get_library_location():
-    root = os.path.dirname(__file__.decode(sys.getfilesystemencoding()))
+    root = get_module_dir()
     if os.name == 'nt':
         libname = 'RHVoice.dll'
     else:
@@ -167,7 +206,7 @@ def get_library_location():
     return libpath
 
 def get_datadir_location():
-    root = os.path.dirname(__file__.decode(sys.getfilesystemencoding()))
+    root = get_module_dir()
     lookup_paths = ["RHVoice.langdata", "../../data", "data"]
     for p in lookup_paths:
         datadir = os.path.abspath(os.path.join(root, p))
@@ -202,6 +241,13 @@ def load_tts_library():
     lib.RHVoice_delete_message.restype=None
     lib.RHVoice_speak.argtypes=(RHVoice_message,)
     lib.RHVoice_speak.restype=c_int
+    try:
+        lib.RHVoice_cancel.argtypes=(RHVoice_message,)
+        lib.RHVoice_cancel.restype=None
+        lib.RHVoice_set_audio_buffer_size.argtypes=(RHVoice_tts_engine,c_uint)
+        lib.RHVoice_set_audio_buffer_size.restype=None
+    except AttributeError:  # older library
+        pass
     return lib
 
 
@@ -209,6 +255,10 @@ class SpeechCallback(object):
     """
     This is a callable object for using in RHVoice speech_callback. The
     only obligatory part is __call__() method with its parameters.
+
+    Other methods receive the rest of engine events. They are only
+    called for engines created with Engine class, and should return
+    False to stop synthesis too.
     """
     sample_size = sizeof(c_short)
 
@@ -216,18 +266,44 @@ class SpeechCallback(object):
         """Should return False to stop synthesis"""
         return True
 
+    def process_mark(self, name):
+        return True
+
+    def word_starts(self, position, length):
+        return True
+
+    def word_ends(self, position, length):
+        return True
+
+    def sentence_starts(self, position, length):
+        return True
+
+    def sentence_ends(self, position, length):
+        return True
+
+    def play_audio(self, src):
+        return True
+
+    def samples_view(self, samples, count):
+        """
+        Returns memoryview of samples from the engine without copying
+        them. It is only valid until the callback returns.
+        """
+        size = count*self.sample_size
+        return memoryview((c_char*size).from_address(addressof(samples.contents)))
+
 class DebugCallback(SpeechCallback):
     """ Callback that prints info about generated samples. """
     def __init__(self):
         self.counter = 0
         self.datasize = 0
-        self.starttime = time.clock()
+        self.starttime = clock()
 
     def __call__(self, samples, count, user_data):
         self.counter += 1
         size = count*self.sample_size
         self.datasize += size
-        kbps = self.datasize / (time.clock() - self.starttime) / 1024
+        kbps = self.datasize / (clock() - self.starttime) / 1024
         self.debug(count, size, kbps)
         return True
 
@@ -236,41 +312,341 @@ class DebugCallback(SpeechCallback):
 
 class WaveWriteCallback(SpeechCallback):
     """ Callback that writes sound to wave file. """
-    def __init__(self, filename, ):
+    def __init__(self, filename, sample_rate=16000):
         super(WaveWriteCallback, self).__init__()
         self.wavefile = wave.open(filename, 'wb')
         self.wavefile.setnchannels(1)
         self.wavefile.setsampwidth(self.sample_size)
-        self.wavefile.setframerate(16000)
+        self.wavefile.setframerate(sample_rate)
+        self.samples = 0
 
     def __call__(self, samples, count, user_data):
         """Should return False to stop synthesis"""
-        self.wavefile.writeframes(string_at(samples, count*self.sample_size))
+        self.wavefile.writeframes(self.samples_view(samples, count))
+        self.samples += count
         return True
 
+    def close(self):
+        self.wavefile.close()
+
+class RawWriteCallback(SpeechCallback):
+    """
+    Callback that writes 16 bit mono PCM to file object as soon as it
+    arrives, for pipes, FIFOs and sockets. The file is not closed.
+    Exception raised by writing (e.g. reader has gone away) stops
+    synthesis and is kept in error attribute, as exceptions can't
+    pass through the library.
+    """
+    def __init__(self, f, sample_rate=16000):
+        super(RawWriteCallback, self).__init__()
+        self.file = f
+        self.sample_rate = sample_rate
+        self.samples = 0
+        self.error = None
+
+    def __call__(self, samples, count, user_data):
+        """Should return False to stop synthesis"""
+        try:
+            self.file.write(self.samples_view(samples, count))
+            self.file.flush()
+        except Exception as e:
+            self.error = e
+            return False
+        self.samples += count
+        return True
+
+    def close(self):
+        pass
+
+class WaveStreamCallback(RawWriteCallback):
+    """
+    RawWriteCallback which starts with WAV header. Length of audio is
+    not known in advance, so the header has maximum sizes, like other
+    streaming tools write, and the file needs no seeking.
+    """
+    def __init__(self, f, sample_rate=16000):
+        super(WaveStreamCallback, self).__init__(f, sample_rate)
+        unknown = 0xFFFFFFFF
+        f.write(struct.pack("<4sI4s4sIHHIIHH4sI",
+                            b"RIFF", unknown, b"WAVE", b"fmt ", 16,
+                            1, 1, sample_rate, sample_rate*self.sample_size,
+                            self.sample_size, 8*self.sample_size,
+                            b"data", unknown))
+        f.flush()
+
+OUTPUT_FORMATS = {
+    "wav": WaveWriteCallback,
+    "raw": RawWriteCallback,
+    "wav-stream": WaveStreamCallback,
+}
+
+def get_binary_stdout():
+    """ Returns stdout for writing bytes """
+    if hasattr(sys.stdout, "buffer"):
+        return sys.stdout.buffer
+    # Python 2: text mode file doesn't accept memoryview, and
+    # translates newlines on Windows
+    if sys.platform == "win32":
+        import msvcrt
+        msvcrt.setmode(sys.stdout.fileno(), os.O_BINARY)
+    return os.fdopen(sys.stdout.fileno(), "wb", 0)
+
+class StreamEvent:
+    """ Kinds of items yielded by Engine.synthesize_iter() """
+    audio = "audio"
+    mark = "mark"
+    word_starts = "word_starts"
+    word_ends = "word_ends"
+    sentence_starts = "sentence_starts"
+    sentence_ends = "sentence_ends"
+    play_audio = "play_audio"
+
+class StreamCallback(SpeechCallback):
+    """
+    Callback that passes speech and events to Engine.synthesize_iter()
+    running in another thread. Samples are copied into a few buffers
+    allocated once, and each buffer is reused as soon as the consumer
+    has moved on to the next item.
+    """
+    def __init__(self, chunk_size, buffers=2):
+        super(StreamCallback, self).__init__()
+        size = chunk_size*self.sample_size
+        self.buffers = [bytearray(size) for i in range(buffers)]
+        self.views = [memoryview(b) for b in self.buffers]
+        # (c_char*size).from_buffer() pins the buffer, keep it referenced
+        self.c_buffers = [(c_char*size).from_buffer(b) for b in self.buffers]
+        self.addresses = [addressof(b) for b in self.c_buffers]
+        self.free = Queue.Queue()
+        for i in range(buffers):
+            self.free.put(i)
+        self.events = Queue.Queue()
+        self.stopped = False
+        self.finished = False
+
+    def __call__(self, samples, count, user_data):
+        source = addressof(samples.contents)
+        size = count*self.sample_size
+        offset = 0
+        while offset < size:
+            index = self.free.get()
+            if self.stopped:
+                return False
+            chunk = min(len(self.buffers[index]), size - offset)
+            memmove(self.addresses[index], source + offset, chunk)
+            self.events.put((StreamEvent.audio, index, chunk))
+            offset += chunk
+        return True
+
+    def event(self, kind, value):
+        self.events.put((kind, value, None))
+        return not self.stopped
+
+    def process_mark(self, name):
+        return self.event(StreamEvent.mark, name)
+
+    def word_starts(self, position, length):
+        return self.event(StreamEvent.word_starts, (position, length))
+
+    def word_ends(self, position, length):
+        return self.event(StreamEvent.word_ends, (position, length))
+
+    def sentence_starts(self, position, length):
+        return self.event(StreamEvent.sentence_starts, (position, length))
+
+    def sentence_ends(self, position, length):
+        return self.event(StreamEvent.sentence_ends, (position, length))
+
+    def play_audio(self, src):
+        return self.event(StreamEvent.play_audio, src)
+
+    def finish(self, error=None):
+        """ Called from synthesis thread when the message is done. """
+        self.events.put((None, error, None))
+
+    def stop(self):
+        """ Makes the synthesis thread give up as soon as possible. """
+        self.stopped = True
+        for i in range(len(self.buffers)):
+            self.free.put(i)
+
+    def __iter__(self):
+        held = None
+        while True:
+            kind, value, size = self.events.get()
+            if held is not None:
+                self.free.put(held)
+                held = None
+            if kind is None:
+                self.finished = True
+                if value is not None:
+                    raise value
+                break
+            if kind == StreamEvent.audio:
+                held = value
+                yield kind, self.views[value][:size]
+            else:
+                yield kind, value
+
+class AsyncStreamCallback(SpeechCallback):
+    """
+    Callback that passes speech and events of one message to asyncio
+    event loop (see Engine.synthesize_async()). Synthesis runs in an
+    executor, and no more than queue_size items are waiting for the
+    consumer: when the queue is full, the callback blocks synthesis
+    thread until the consumer takes the next item. After stop() it
+    returns 0, so synthesis ends as soon as possible.
+    """
+    def __init__(self, speak, queue_size=16, loop=None, executor=None):
+        import asyncio
+        super(AsyncStreamCallback, self).__init__()
+        self.loop = loop or asyncio.get_event_loop()
+        # items and waiter are only touched in the event loop thread
+        self.items = collections.deque()
+        self.waiter = None
+        self.space = threading.Semaphore(queue_size)
+        self.stopped = False
+        self.done = self.loop.run_in_executor(executor, speak, self)
+        self.done.add_done_callback(self.deliver)
+
+    def put(self, item):
+        """ Called from synthesis thread """
+        if self.stopped:
+            return False
+        self.space.acquire()
+        if self.stopped:
+            return False
+        self.loop.call_soon_threadsafe(self.deliver, item)
+        return True
+
+    def deliver(self, item):
+        if self.waiter is not None and not self.waiter.done():
+            self.resolve(self.waiter, item)
+        else:
+            self.items.append(item)
+        self.waiter = None
+
+    def resolve(self, future, item):
+        if item is not self.done:
+            self.space.release()
+            future.set_result(item)
+        else:
+            # keep end of stream for any later __anext__()
+            self.items.append(item)
+            if not self.done.cancelled() and self.done.exception() is not None:
+                future.set_exception(self.done.exception())
+            else:
+                future.set_exception(StopAsyncIteration())
+
+    def on_waiter_done(self, future):
+        if future.cancelled():
+            self.stop()
+
+    def stop(self):
+        if not self.stopped:
+            self.stopped = True
+            self.space.release()
+
+    def __call__(self, samples, count, user_data):
+        return self.put((StreamEvent.audio, string_at(samples, count*self.sample_size)))
+
+    def process_mark(self, name):
+        return self.put((StreamEvent.mark, name))
+
+    def word_starts(self, position, length):
+        return self.put((StreamEvent.word_starts, (position, length)))
+
+    def word_ends(self, position, length):
+        return self.put((StreamEvent.word_ends, (position, length)))
+
+    def sentence_starts(self, position, length):
+        return self.put((StreamEvent.sentence_starts, (position, length)))
+
+    def sentence_ends(self, position, length):
+        return self.put((StreamEvent.sentence_ends, (position, length)))
+
+    def play_audio(self, src):
+        return self.put((StreamEvent.play_audio, src))
+
+    def next_item(self):
+        future = self.loop.create_future()
+        if self.items:
+            self.resolve(future, self.items.popleft())
+        else:
+            self.waiter = future
+            future.add_done_callback(self.on_waiter_done)
+        return future
+
+    def close(self):
+        """ Stops synthesis, returns future which is done when it ends """
+        self.stop()
+        future = self.loop.create_future()
+        def finished(done):
+            if not future.done():
+                future.set_result(None)
+        self.done.add_done_callback(finished)
+        return future
+
+class AsyncSpeechStream(object):
+    """
+    Asynchronous iterator returned by synthesize_async(). Synthesis is
+    stopped when the consumer is cancelled while waiting for an item,
+    when aclose() is called or async with block is left, and when the
+    stream is garbage collected.
+    """
+    def __init__(self, callback):
+        # callback must not refer back to the stream
+        self.callback = callback
+
+    def __aiter__(self):
+        return self
+
+    def __anext__(self):
+        return self.callback.next_item()
+
+    def aclose(self):
+        return self.callback.close()
+
+    def __aenter__(self):
+        future = self.callback.loop.create_future()
+        future.set_result(self)
+        return future
+
+    def __aexit__(self, *exc_info):
+        return self.aclose()
+
+    def __del__(self):
+        self.callback.stop()
+
 
 # --- Global state. High level API ---
 
 # Reference to loaded library
 LIB = None
+LIB_LOCK = threading.Lock()
 
-def get_rhvoice_version():
+def get_library():
+    """ Load DLL on first use and return it """
     global LIB
-    if not LIB:
-        LIB = load_tts_library()
-    return LIB.RHVoice_get_version()
+    with LIB_LOCK:
+        if not LIB:
+            LIB = load_tts_library()
+    return LIB
+
+def get_rhvoice_version():
+    return get_library().RHVoice_get_version()
 
-def init_rhvoice(datadir=get_datadir_location(), callback=DebugCallback()):
+def init_rhvoice(datadir=None, callback=None):
     """
     Load DLL and initialize speech engine - load language data
-    and set callbacks.
+    and set callbacks. By default data is looked up with
+    get_datadir_location() and speech goes to DebugCallback.
     """
-       
-    global LIB
     global init_params  # need to preserve reference for ctypes
-    if not LIB:
-        LIB = load_tts_library()
-    LIB.RHVoice_set_logging(True)
+    if datadir is None:
+        datadir = get_datadir_location()
+    if callback is None:
+        callback = DebugCallback()
+    get_library().RHVoice_set_logging(True)
 
     # creating obligatory callback with .play_speech()
     # RHVoice_new_tts_engine fails without callback
@@ -289,7 +665,7 @@ def init_rhvoice(datadir=get_datadir_location(), callback=DebugCallback()):
     """
 
     init_params = RHVoice_init_params()
-    init_params.data_path = datadir
+    init_params.data_path = to_bytes(datadir)
     init_params.callbacks = callbacks
 
     return LIB.RHVoice_new_tts_engine(byref(init_params))
@@ -316,6 +692,1417 @@ def get_voices(engine):
         )
     return voices
 
+def get_voice_profiles(engine):
+    """ Returns list of voice profile names, e.g. "Aleksandr+Alan" """
+    lib = get_library()
+    profiles_total = lib.RHVoice_get_number_of_voice_profiles(engine)
+    first_profile = lib.RHVoice_get_voice_profiles(engine)
+    return [first_profile[profno] for profno in range(profiles_total)]
+
+def new_synth_params(voice_profile, rate=1.0, pitch=1.0, volume=1.0):
+    """
+    Returns RHVoice_synth_params for voice_profile with relative rate,
+    pitch and volume (1.0 is the default for all of them).
+    """
+    synth_params = RHVoice_synth_params()
+    synth_params.voice_profile = to_bytes(voice_profile)
+    synth_params.relative_rate = rate
+    synth_params.relative_pitch = pitch
+    synth_params.relative_volume = volume
+    synth_params.punctuation_mode = RHVoice_punctuation_mode.default
+    synth_params.capitals_mode = RHVoice_capitals_mode.default
+    return synth_params
+
+
+class CallbackRouter(object):
+    """
+    Holds C callbacks of one engine and dispatches every call to the
+    SpeechCallback registered for the message being spoken. Messages
+    are told apart by their user_data, so the callbacks bound to the
+    engine at creation time never change.
+    """
+    def __init__(self):
+        self.handlers = dict()
+        self.keys = itertools.count(1)
+        self.lock = threading.Lock()
+        types = RHVoice_callback_types
+        self.callbacks = RHVoice_callbacks(
+            types.play_speech(self.play_speech),
+            types.process_mark(self.process_mark),
+            types.word_starts(self.word_starts),
+            types.word_ends(self.word_ends),
+            types.sentence_starts(self.sentence_starts),
+            types.sentence_ends(self.sentence_ends),
+            types.play_audio(self.play_audio))
+
+    def register(self, handler):
+        """ Returns user_data for a message which is spoken to handler """
+        with self.lock:
+            key = next(self.keys)
+            self.handlers[key] = handler
+        return key
+
+    def unregister(self, key):
+        with self.lock:
+            del self.handlers[key]
+
+    def play_speech(self, samples, count, user_data):
+        return self.handlers[user_data](samples, count, user_data)
+
+    def process_mark(self, name, user_data):
+        return self.handlers[user_data].process_mark(name)
+
+    def word_starts(self, position, length, user_data):
+        return self.handlers[user_data].word_starts(position, length)
+
+    def word_ends(self, position, length, user_data):
+        return self.handlers[user_data].word_ends(position, length)
+
+    def sentence_starts(self, position, length, user_data):
+        return self.handlers[user_data].sentence_starts(position, length)
+
+    def sentence_ends(self, position, length, user_data):
+        return self.handlers[user_data].sentence_ends(position, length)
+
+    def play_audio(self, src, user_data):
+        return self.handlers[user_data].play_audio(src)
+
+
+class Engine(object):
+    """
+    RHVoice_tts_engine with its own callbacks. Unlike init_rhvoice(),
+    speech goes to the callback given for each message, so the same
+    engine can be reused for any number of texts and outputs.
+
+    Engine object can be passed to library functions and to
+    get_voices() in place of RHVoice_tts_engine.
+
+    With SynthesisCache, messages spoken before are replayed from it
+    without touching the library.
+
+    options are RHVoice_init_option flags, preload_voices loads every
+    language and voice while engine is created.
+
+    audio_buffer_size is the amount of speech in milliseconds passed
+    to callbacks at once (library default is 100), 0 means the whole
+    sentence. Larger blocks cost fewer Python calls, but delay the
+    first audio and events come ahead of their audio.
+    """
+    def __init__(self, datadir=None, config_path=None, resource_paths=None,
+                 cache=None, options=0, audio_buffer_size=None):
+        self.lib = get_library()
+        self.router = CallbackRouter()
+        self.cache = cache
+        self.datadir = datadir
+        self.data_versions = dict()
+        self.resources = None
+        self.messages = dict()
+        self.message_threads = dict()
+        self.messages_lock = threading.Lock()
+        self.cancel_times = dict()
+        self.cancel_latency = LatencyCounter()
+        # keep references to everything ctypes points to
+        self.resource_paths = None
+        if resource_paths:
+            paths = [to_bytes(p) for p in resource_paths]
+            self.resource_paths = (c_char_p*(len(paths)+1))(*(paths+[None]))
+        self.resource_dirs = list(resource_paths or [])
+        self.init_params = RHVoice_init_params(to_bytes(datadir),
+                                               to_bytes(config_path),
+                                               self.resource_paths,
+                                               self.router.callbacks, options)
+        self.handle = self.lib.RHVoice_new_tts_engine(byref(self.init_params))
+        if not self.handle:
+            raise RuntimeError("RHVoice: engine initialization error")
+        self._as_parameter_ = self.handle
+        if audio_buffer_size is not None:
+            if not hasattr(self.lib, "RHVoice_set_audio_buffer_size"):
+                self.close()
+                raise RuntimeError("RHVoice: library can not change audio buffer size")
+            self.lib.RHVoice_set_audio_buffer_size(self.handle, audio_buffer_size)
+
+    def close(self):
+        if self.handle:
+            self.lib.RHVoice_delete_tts_engine(self.handle)
+            self.handle = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def get_resources(self):
+        """ find_resources() for data of this engine """
+        if self.resources is None:
+            self.resources = find_resources(self.datadir, self.resource_dirs)
+        return self.resources
+
+    def get_data_version(self, voice_profile):
+        """ Versions of voices and languages used by voice_profile """
+        if voice_profile not in self.data_versions:
+            self.data_versions[voice_profile] = get_data_version(voice_profile, self.get_resources())
+        return self.data_versions[voice_profile]
+
+    def get_sample_rate(self, voice_profile):
+        """ Sample rate of speech produced with voice_profile """
+        return get_sample_rate(voice_profile, self.get_resources())
+
+    def warm_up(self, voice_profiles=None, text="123."):
+        """
+        Speaks text with every profile of voice_profiles (all of them
+        by default), discarding the speech, so data of their voices and
+        languages is loaded and synthesis instances are created before
+        they are needed. text should be readable in every language,
+        numbers are. Returns list of (profile, seconds) pairs.
+        """
+        if voice_profiles is None:
+            voice_profiles = get_voice_profiles(self)
+        null = SpeechCallback()
+        report = []
+        for profile in voice_profiles:
+            seconds, result = time_call(self.speak_message, to_bytes(text),
+                                        new_synth_params(profile), null,
+                                        RHVoice_message_type.text)
+            report.append((profile, seconds))
+        return report
+
+    def speak(self, text, synth_params, callback,
+              message_type=RHVoice_message_type.text):
+        """
+        Synthesize text (UTF-8 encoded or unicode) with synth_params,
+        sending speech and events to callback. Returns False if the
+        library failed to speak the message or the callback stopped it.
+        """
+        text = to_bytes(text)
+        if self.cache is None:
+            return self.speak_message(text, synth_params, callback, message_type)
+        key = self.cache.make_key(text, message_type, synth_params,
+                                  self.get_data_version(synth_params.voice_profile))
+        speech = self.cache.get(key)
+        if speech is not None:
+            return speech.replay(callback)
+        recorder = SpeechRecorder(callback)
+        result = self.speak_message(text, synth_params, recorder, message_type)
+        if result and not recorder.stopped:
+            self.cache.put(key, recorder.get_speech())
+        return result
+
+    def speak_message(self, text, synth_params, callback, message_type):
+        """ speak() bypassing the cache """
+        key = self.router.register(callback)
+        try:
+            message = self.lib.RHVoice_new_message(self, text, len(text),
+                                                   message_type,
+                                                   byref(synth_params), key)
+            if not message:
+                raise RuntimeError("RHVoice: message building error")
+            with self.messages_lock:
+                self.messages[key] = message
+                self.message_threads[key] = threading.current_thread()
+            try:
+                return bool(self.lib.RHVoice_speak(message))
+            finally:
+                with self.messages_lock:
+                    del self.messages[key]
+                    del self.message_threads[key]
+                    cancel_time = self.cancel_times.pop(key, None)
+                if cancel_time is not None:
+                    self.cancel_latency.add(clock() - cancel_time)
+                self.lib.RHVoice_delete_message(message)
+        finally:
+            self.router.unregister(key)
+
+    def message_keys(self, thread=None):
+        """ Keys of the messages being spoken, only by thread if given """
+        with self.messages_lock:
+            return [key for key, owner in self.message_threads.items()
+                    if thread is None or owner is thread]
+
+    def cancel(self, key=None):
+        """
+        Makes every message being spoken by this engine (or only the
+        one with key from message_keys()) stop as soon as possible,
+        e.g. from another thread. Synthesis is checked for cancellation
+        between sentences and processing stages, so it does not wait
+        for the next audio chunk. Time from cancel() until speak()
+        returns is counted in cancel_latency. With libraries which have
+        no RHVoice_cancel, callbacks must stop synthesis.
+        """
+        with self.messages_lock:
+            if key is None:
+                keys = list(self.messages)
+            elif key in self.messages:
+                keys = [key]
+            else:
+                return
+            for key in keys:
+                self.cancel_times.setdefault(key, clock())
+                if hasattr(self.lib, "RHVoice_cancel"):
+                    self.lib.RHVoice_cancel(self.messages[key])
+
+    def synthesize_iter(self, text, synth_params,
+                        message_type=RHVoice_message_type.text,
+                        chunk_size=8192):
+        """
+        Generator of (kind, value) pairs, where kind is one of
+        StreamEvent values. Audio comes as memoryview of at most
+        chunk_size 16 bit samples, marks as their names, word and
+        sentence boundaries as (position, length) in the text.
+
+        Memoryview is backed by a reused buffer and is valid only
+        until the next item is requested - copy it to keep it.
+        Closing the generator early stops synthesis.
+        """
+        callback = StreamCallback(chunk_size)
+
+        def run():
+            try:
+                self.speak(text, synth_params, callback, message_type)
+            except Exception as e:
+                callback.finish(e)
+            else:
+                callback.finish()
+
+        thread = threading.Thread(target=run)
+        thread.daemon = True
+        thread.start()
+        try:
+            for item in callback:
+                yield item
+        finally:
+            if not callback.finished:
+                callback.stop()
+                for key in self.message_keys(thread):
+                    self.cancel(key)
+                try:
+                    for item in callback:
+                        pass
+                except Exception:
+                    pass
+            thread.join()
+
+    def synthesize_async(self, text, synth_params,
+                         message_type=RHVoice_message_type.text,
+                         queue_size=16, loop=None, executor=None):
+        """
+        Asynchronous iterator of (kind, value) pairs for asyncio, like
+        synthesize_iter(), but audio comes as bytes:
+
+            async for kind, value in engine.synthesize_async(text, params):
+                ...
+
+        RHVoice_speak runs in executor (the loop default one if it is
+        None). At most queue_size items are buffered, after that
+        synthesis waits for the consumer.
+        """
+        def speak(callback):
+            return self.speak(text, synth_params, callback, message_type)
+        return AsyncSpeechStream(AsyncStreamCallback(speak, queue_size, loop, executor))
+
+class LatencyCounter(object):
+    """ Number, mean and maximum of measured delays in seconds """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.count = 0
+        self.total = self.max = 0.0
+
+    def add(self, seconds):
+        with self.lock:
+            self.count += 1
+            self.total += seconds
+            self.max = max(self.max, seconds)
+
+    def get_stats(self):
+        with self.lock:
+            return dict(count=self.count,
+                        mean_ms=self.total / self.count * 1000 if self.count else 0.0,
+                        max_ms=self.max * 1000)
+
+# --- cache ---
+
+def read_resource_info(path):
+    """ Returns dictionary of settings from language.info or voice.info """
+    info = dict()
+    with open(path, "rb") as f:
+        for line in f:
+            line = line.decode("utf-8").strip()
+            if "=" in line and not line.startswith("#"):
+                name, value = line.split("=", 1)
+                info[name.strip()] = value.strip()
+    return info
+
+def find_resources(datadir=None, resource_paths=()):
+    """
+    Looks for language and voice data where the library does. Returns
+    dictionary with ("language"|"voice", lowercase name) keys and
+    contents of their .info files plus "path" of data as values.
+    """
+    dirs = []
+    if datadir:
+        for subdir in ("languages", "voices"):
+            parent = os.path.join(datadir, subdir)
+            if os.path.isdir(parent):
+                dirs.extend(os.path.join(parent, d) for d in sorted(os.listdir(parent)))
+    dirs.extend(resource_paths)
+    resources = dict()
+    for d in dirs:
+        for kind in ("language", "voice"):
+            path = os.path.join(d, kind + ".info")
+            if os.path.isfile(path):
+                info = read_resource_info(path)
+                info["path"] = d
+                resources[(kind, info.get("name", "").lower())] = info
+    return resources
+
+def get_data_version(voice_profile, resources):
+    """
+    Returns string with format and revision of every voice of
+    voice_profile and of its language, e.g. "Alan:1.0/English:1.3".
+    resources is what find_resources() returns.
+    """
+    if isinstance(voice_profile, bytes):
+        voice_profile = voice_profile.decode("utf-8")
+    parts = []
+    for name in (voice_profile or "").split("+"):
+        voice = resources.get(("voice", name.strip().lower()))
+        if voice is None:
+            continue
+        language = resources.get(("language", voice.get("language", "").lower()), {})
+        for info in (voice, language):
+            parts.append("%s:%s.%s" % (info.get("name"), info.get("format"), info.get("revision")))
+    return "/".join(parts)
+
+def get_sample_rate(voice_profile, resources, default=16000):
+    """
+    Returns sample rate in Hz of the first voice of voice_profile from
+    its voice.info ("16k" or "16000"), or default if it is unknown.
+    """
+    if isinstance(voice_profile, bytes):
+        voice_profile = voice_profile.decode("utf-8")
+    name = (voice_profile or "").split("+")[0].strip().lower()
+    value = resources.get(("voice", name), {}).get("sample_rate", "")
+    try:
+        if value.lower().endswith("k"):
+            return int(float(value[:-1]) * 1000)
+        return int(value)
+    except ValueError:
+        return default
+
+
+def get_event_method(callback, kind):
+    """ Returns method of SpeechCallback which handles kind of events """
+    if kind == StreamEvent.mark:
+        return callback.process_mark
+    return getattr(callback, kind)
+
+
+class CachedSpeech(object):
+    """
+    Speech and events of one message in the order the engine produced
+    them. Audio events store the number of samples of every chunk.
+    """
+    def __init__(self, pcm, events):
+        self.size = len(pcm)
+        self.buffer = (c_char*self.size).from_buffer_copy(pcm)
+        self.events = events
+
+    def get_pcm(self):
+        return memoryview(self.buffer)
+
+    def replay(self, callback, user_data=None):
+        """
+        Passes everything to callback like the engine would. Returns
+        False if the callback has stopped it.
+        """
+        address = addressof(self.buffer)
+        for kind, value in self.events:
+            if kind == StreamEvent.audio:
+                samples = cast(address, POINTER(c_short))
+                address += value*SpeechCallback.sample_size
+                result = callback(samples, value, user_data)
+            elif kind in (StreamEvent.mark, StreamEvent.play_audio):
+                result = get_event_method(callback, kind)(value)
+            else:
+                result = get_event_method(callback, kind)(*value)
+            if not result:
+                return False
+        return True
+
+    def dump(self, f):
+        """ Writes itself to file: JSON line with events and then PCM """
+        events = [(kind, value.decode("utf-8") if isinstance(value, bytes) else value)
+                  for kind, value in self.events]
+        f.write(json.dumps(events).encode("ascii") + b"\n")
+        f.write(self.get_pcm())
+
+    @classmethod
+    def load(cls, f):
+        events = []
+        for kind, value in json.loads(f.readline().decode("ascii")):
+            if kind in (StreamEvent.mark, StreamEvent.play_audio):
+                value = to_bytes(value)
+            elif kind != StreamEvent.audio:
+                value = tuple(value)
+            events.append((str(kind), value))
+        return cls(f.read(), events)
+
+
+class SpeechRecorder(SpeechCallback):
+    """
+    Callback that records everything passed to it for CachedSpeech
+    and forwards it to another callback, if there is one.
+    """
+    def __init__(self, callback=None):
+        super(SpeechRecorder, self).__init__()
+        self.callback = callback
+        self.pcm = bytearray()
+        self.events = []
+        self.stopped = False
+
+    def forward(self, kind, *args):
+        if self.callback is None:
+            return True
+        if kind == StreamEvent.audio:
+            result = self.callback(*args)
+        else:
+            result = get_event_method(self.callback, kind)(*args)
+        if not result:
+            self.stopped = True
+        return result
+
+    def __call__(self, samples, count, user_data):
+        self.pcm.extend(self.samples_view(samples, count))
+        self.events.append((StreamEvent.audio, count))
+        return self.forward(StreamEvent.audio, samples, count, user_data)
+
+    def process_mark(self, name):
+        self.events.append((StreamEvent.mark, name))
+        return self.forward(StreamEvent.mark, name)
+
+    def play_audio(self, src):
+        self.events.append((StreamEvent.play_audio, src))
+        return self.forward(StreamEvent.play_audio, src)
+
+    def word_starts(self, position, length):
+        self.events.append((StreamEvent.word_starts, (position, length)))
+        return self.forward(StreamEvent.word_starts, position, length)
+
+    def word_ends(self, position, length):
+        self.events.append((StreamEvent.word_ends, (position, length)))
+        return self.forward(StreamEvent.word_ends, position, length)
+
+    def sentence_starts(self, position, length):
+        self.events.append((StreamEvent.sentence_starts, (position, length)))
+        return self.forward(StreamEvent.sentence_starts, position, length)
+
+    def sentence_ends(self, position, length):
+        self.events.append((StreamEvent.sentence_ends, (position, length)))
+        return self.forward(StreamEvent.sentence_ends, position, length)
+
+    def get_speech(self):
+        return CachedSpeech(self.pcm, self.events)
+
+
+class SynthesisCache(object):
+    """
+    Cache of synthesized messages. Keys are made of the message text
+    (SSML with whitespace normalized), all RHVoice_synth_params fields,
+    library version and versions of voice data. Memory tier is LRU
+    limited to max_bytes, optional disk tier keeps one file per key
+    in directory and is not limited.
+    """
+    def __init__(self, max_bytes=32*1024*1024, directory=None):
+        self.max_bytes = max_bytes
+        self.directory = directory
+        self.entries = collections.OrderedDict()
+        self.size = 0
+        self.lock = threading.Lock()
+        self.version = None
+        self.hits = self.disk_hits = self.misses = self.evictions = 0
+
+    def make_key(self, text, message_type, synth_params, data_version=""):
+        if self.version is None:
+            self.version = get_rhvoice_version()
+        text = to_bytes(text).strip()
+        if message_type == RHVoice_message_type.ssml:
+            text = b" ".join(text.split())
+        p = synth_params
+        params = (p.absolute_rate, p.absolute_pitch, p.absolute_volume,
+                  p.relative_rate, p.relative_pitch, p.relative_volume,
+                  p.punctuation_mode, p.capitals_mode)
+        parts = [self.version, data_version, str(message_type),
+                 p.voice_profile or b"", repr(params),
+                 p.punctuation_list or b"", text]
+        return hashlib.sha1(b"\0".join(to_bytes(x) for x in parts)).hexdigest()
+
+    def get_path(self, key):
+        return os.path.join(self.directory, key[:2], key + ".pcm")
+
+    def __contains__(self, key):
+        """ Checks for key without counting a hit or a miss """
+        with self.lock:
+            if key in self.entries:
+                return True
+        return bool(self.directory) and os.path.exists(self.get_path(key))
+
+    def get(self, key):
+        """ Returns CachedSpeech or None """
+        with self.lock:
+            speech = self.entries.pop(key, None)
+            if speech is not None:
+                self.entries[key] = speech
+                self.hits += 1
+                return speech
+        speech = self.read(key)
+        with self.lock:
+            if speech is None:
+                self.misses += 1
+            else:
+                self.disk_hits += 1
+                self.add(key, speech)
+        return speech
+
+    def put(self, key, speech):
+        with self.lock:
+            self.add(key, speech)
+        self.write(key, speech)
+
+    def add(self, key, speech):
+        if speech.size > self.max_bytes:
+            return
+        old = self.entries.pop(key, None)
+        if old is not None:
+            self.size -= old.size
+        self.entries[key] = speech
+        self.size += speech.size
+        while self.size > self.max_bytes:
+            old_key, old = self.entries.popitem(last=False)
+            self.size -= old.size
+            self.evictions += 1
+
+    def read(self, key):
+        if not self.directory:
+            return None
+        try:
+            with open(self.get_path(key), "rb") as f:
+                return CachedSpeech.load(f)
+        except (EnvironmentError, ValueError):
+            return None
+
+    def write(self, key, speech):
+        if not self.directory:
+            return
+        path = self.get_path(key)
+        if os.path.exists(path):
+            return
+        temp_path = "%s.%d.%d.tmp" % (path, os.getpid(), threading.current_thread().ident)
+        try:
+            try:
+                os.makedirs(os.path.dirname(path))
+            except EnvironmentError:
+                if not os.path.isdir(os.path.dirname(path)):
+                    raise
+            with open(temp_path, "wb") as f:
+                speech.dump(f)
+            os.rename(temp_path, path)
+        except EnvironmentError:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+
+    def clear(self):
+        """ Empties memory tier """
+        with self.lock:
+            self.entries.clear()
+            self.size = 0
+
+    def get_stats(self):
+        with self.lock:
+            lookups = self.hits + self.disk_hits + self.misses
+            return dict(hits=self.hits, disk_hits=self.disk_hits,
+                        misses=self.misses, evictions=self.evictions,
+                        entries=len(self.entries), bytes=self.size,
+                        hit_rate=(self.hits + self.disk_hits) / float(lookups) if lookups else 0.0)
+
+
+class EngineBusy(RuntimeError):
+    """ Raised by EnginePool when all its engines are in use """
+
+
+class EnginePool(object):
+    """
+    Set of engines for synthesizing in several threads at once. Every
+    engine has its own callbacks and is used by one thread at a time.
+    ctypes releases the GIL while the library is synthesizing, so
+    Python code only competes for it inside callbacks.
+
+        pool = EnginePool(4, datadir)
+        with pool.engine() as engine:
+            engine.speak(text, synth_params, callback)
+    """
+    def __init__(self, size=None, datadir=None, config_path=None,
+                 resource_paths=None, options=0, audio_buffer_size=None):
+        if size is None:
+            import multiprocessing
+            size = multiprocessing.cpu_count()
+        self.engines = []
+        self.idle = Queue.Queue()
+        try:
+            for i in range(size):
+                engine = Engine(datadir, config_path, resource_paths,
+                                options=options,
+                                audio_buffer_size=audio_buffer_size)
+                self.engines.append(engine)
+                self.idle.put(engine)
+        except:
+            self.close()
+            raise
+
+    def __len__(self):
+        return len(self.engines)
+
+    def acquire(self, block=True, timeout=None):
+        """
+        Returns an idle engine, waiting for one if block is True (at
+        most timeout seconds, if it is given). Raises EngineBusy if
+        there are no idle engines.
+        """
+        try:
+            return self.idle.get(block, timeout)
+        except Queue.Empty:
+            raise EngineBusy("RHVoice: all %d engines are busy" % len(self.engines))
+
+    def release(self, engine):
+        self.idle.put(engine)
+
+    @contextlib.contextmanager
+    def engine(self, block=True, timeout=None):
+        """ acquire() for the duration of with statement """
+        engine = self.acquire(block, timeout)
+        try:
+            yield engine
+        finally:
+            self.release(engine)
+
+    def speak(self, text, synth_params, callback,
+              message_type=RHVoice_message_type.text,
+              block=True, timeout=None):
+        """ Engine.speak() with any idle engine """
+        with self.engine(block, timeout) as engine:
+            return engine.speak(text, synth_params, callback, message_type)
+
+    def synthesize_async(self, text, synth_params,
+                         message_type=RHVoice_message_type.text,
+                         queue_size=16, loop=None, executor=None):
+        """
+        Engine.synthesize_async() with the first engine which becomes
+        idle. Waiting for it happens in executor too.
+        """
+        def speak(callback):
+            return self.speak(text, synth_params, callback, message_type)
+        return AsyncSpeechStream(AsyncStreamCallback(speak, queue_size, loop, executor))
+
+    def warm_up(self, voice_profiles=None, text="123."):
+        """
+        Engine.warm_up() of every engine, which must be idle, so none
+        of them creates synthesis instances on the first request.
+        Returns total seconds spent by each engine.
+        """
+        return [sum(seconds for profile, seconds in engine.warm_up(voice_profiles, text))
+                for engine in self.engines]
+
+    def close(self):
+        """ Deletes all engines, they must not be in use """
+        for engine in self.engines:
+            engine.close()
+        self.engines = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+# --- startup profile ---
+
+def time_call(function, *args):
+    """ Returns seconds spent in function(*args) and its result """
+    starttime = clock()
+    result = function(*args)
+    return clock() - starttime, result
+
+def profile_startup(datadir=None, text="123."):
+    """
+    Measures where cold start time goes. Returns list of (stage,
+    name, seconds) tuples for loading the library, creating engine,
+    and for loading every language and voice.
+
+    The library only reads .info files when engine is created, and
+    loads language and voice data when they are first used. So data
+    loading is measured as the difference between the first and the
+    second message spoken by a voice in a new engine with only its
+    language. The first voice also pays for the language. With two
+    voices or more, each of them is spoken first in its own engine,
+    which separates language and voice costs. For a language with a
+    single voice they are reported together, under "language+voice".
+    text should be readable in every language, numbers are.
+    """
+    if datadir is None:
+        datadir = get_datadir_location()
+    report = []
+    loaded = LIB is not None
+    seconds, lib = time_call(get_library)
+    report.append(("library", "already loaded" if loaded else get_library_location(), seconds))
+    seconds, engine = time_call(Engine, datadir)
+    report.append(("engine", datadir, seconds))
+    engine.close()
+    resources = find_resources(datadir)
+    languages = collections.defaultdict(list)
+    for (kind, name), info in sorted(resources.items()):
+        if kind == "voice":
+            languages[info.get("language", "").lower()].append(info)
+    null = SpeechCallback()
+
+    def first_use(paths, voices):
+        """ Returns cost of first message spoken by each voice """
+        costs = []
+        with Engine("", resource_paths=paths) as engine:
+            for voice in voices:
+                params = new_synth_params(voice["name"])
+                cold, result = time_call(engine.speak, text, params, null)
+                warm, result = time_call(engine.speak, text, params, null)
+                costs.append(max(cold - warm, 0.0))
+        return costs
+
+    for language_name, voices in sorted(languages.items()):
+        language = resources.get(("language", language_name))
+        if language is None:
+            continue
+        paths = [language["path"]] + [v["path"] for v in voices]
+        if len(voices) == 1:
+            report.append(("language+voice", "%s+%s" % (language["name"], voices[0]["name"]),
+                           first_use(paths, voices)[0]))
+            continue
+        # each of the first two voices is once loaded with the language
+        # and once on its own
+        a = first_use(paths, voices)
+        b = first_use(paths, [voices[1], voices[0]])
+        voice_costs = [b[1], b[0]] + a[2:]
+        language_cost = ((a[0] - voice_costs[0]) + (b[0] - voice_costs[1])) / 2
+        report.append(("language", language["name"], max(language_cost, 0.0)))
+        for voice, cost in zip(voices, voice_costs):
+            report.append(("voice", voice["name"], cost))
+    return report
+
+def print_startup_profile(report):
+    total = 0
+    for stage, name, seconds in report:
+        total += seconds
+        print("  %-15s %-25s %8.1f ms" % (stage, name, seconds*1000))
+    print("  %-41s %8.1f ms" % ("total", total*1000))
+
+
+# --- benchmark ---
+
+# Texts spoken by every voice of the language: (name, message type,
+# text). Changing them makes results incomparable with old baselines.
+BENCHMARK_CORPUS = {
+    "English": [
+        ("short", RHVoice_message_type.text, u"Hello."),
+        ("medium", RHVoice_message_type.text,
+         u"The quick brown fox jumps over the lazy dog, and then it runs "
+         u"back into the forest before anyone notices."),
+        ("long", RHVoice_message_type.text,
+         u"Alice was beginning to get very tired of sitting by her sister on "
+         u"the bank, and of having nothing to do: once or twice she had peeped "
+         u"into the book her sister was reading, but it had no pictures or "
+         u"conversations in it, and what is the use of a book, thought Alice, "
+         u"without pictures or conversations? So she was considering in her "
+         u"own mind, as well as she could, for the hot day made her feel very "
+         u"sleepy and stupid, whether the pleasure of making a daisy-chain "
+         u"would be worth the trouble of getting up and picking the daisies, "
+         u"when suddenly a White Rabbit with pink eyes ran close by her."),
+        ("ssml", RHVoice_message_type.ssml,
+         u'<speak xml:lang="en"><s>The meeting starts at <say-as '
+         u'interpret-as="characters">UTC</say-as> nine.</s><s><prosody '
+         u'rate="150%">Please be on time.</prosody></s><s>Thank you.</s></speak>'),
+    ],
+    "Russian": [
+        ("short", RHVoice_message_type.text, u"Привет."),
+        ("medium", RHVoice_message_type.text,
+         u"Все счастливые семьи похожи друг на друга, каждая несчастливая "
+         u"семья несчастлива по-своему."),
+        ("long", RHVoice_message_type.text,
+         u"Всё смешалось в доме Облонских. Жена узнала, что муж был в связи с "
+         u"бывшею в их доме француженкою-гувернанткой, и объявила мужу, что не "
+         u"может жить с ним в одном доме. Положение это продолжалось уже третий "
+         u"день и мучительно чувствовалось и самими супругами, и всеми членами "
+         u"семьи, и домочадцами. Все члены семьи и домочадцы чувствовали, что "
+         u"нет смысла в их сожительстве и что на каждом постоялом дворе "
+         u"случайно сошедшиеся люди более связаны между собой, чем они."),
+        ("ssml", RHVoice_message_type.ssml,
+         u'<speak xml:lang="ru"><s>Встреча начнётся в девять часов.</s><s>'
+         u'<prosody rate="150%">Пожалуйста, не опаздывайте.</prosody></s>'
+         u'<s>Спасибо.</s></speak>'),
+    ],
+    "Georgian": [
+        ("short", RHVoice_message_type.text, u"გამარჯობა."),
+        ("medium", RHVoice_message_type.text,
+         u"ყველა ადამიანი იბადება თავისუფალი და თანასწორი თავისი ღირსებითა და "
+         u"უფლებებით."),
+        ("long", RHVoice_message_type.text,
+         u"ყველა ადამიანი იბადება თავისუფალი და თანასწორი თავისი ღირსებითა და "
+         u"უფლებებით. მათ მინიჭებული აქვთ გონება და სინდისი და ერთმანეთის "
+         u"მიმართ უნდა იქცეოდნენ ძმობის სულისკვეთებით. ყველა ადამიანი "
+         u"იბადება თავისუფალი და თანასწორი თავისი ღირსებითა და უფლებებით."),
+        ("ssml", RHVoice_message_type.ssml,
+         u'<speak xml:lang="ka"><s>ყველა ადამიანი იბადება თავისუფალი.</s><s>'
+         u'<prosody rate="150%">მათ მინიჭებული აქვთ გონება და სინდისი.</prosody>'
+         u'</s></speak>'),
+    ],
+    "Esperanto": [
+        ("short", RHVoice_message_type.text, u"Saluton."),
+        ("medium", RHVoice_message_type.text,
+         u"Alicio, jam longan tempon sidinte apud sia fratino sur la deklivo, "
+         u"tre enuiĝis pro senokupo."),
+        ("long", RHVoice_message_type.text,
+         u"Alicio, jam longan tempon sidinte apud sia fratino sur la deklivo, "
+         u"tre enuiĝis pro senokupo. Unu, du foje ŝi prove rigardis en la "
+         u"libron kiun la fratino legas, sed povis vidi en ĝi nek desegnojn nek "
+         u"konversaciojn, kaj por kio utilas libro, pensis ŝi, enhavanta nek "
+         u"desegnojn nek konversaciojn? Ŝi do ekpripensis, ne tre vigle ĉar la "
+         u"tago estis varma, ĉu la plezuro fari ĉenon el lekantetoj valorus la "
+         u"laboron sin levi kaj kolekti lekantetojn."),
+        ("ssml", RHVoice_message_type.ssml,
+         u'<speak xml:lang="eo"><s>La kunveno komenciĝos je la naŭa.</s><s>'
+         u'<prosody rate="150%">Bonvolu alveni ĝustatempe.</prosody></s>'
+         u'<s>Dankon.</s></speak>'),
+    ],
+}
+
+# Metrics of every voice compared with baseline, and whether their
+# larger values are better. peak_rss_kb is compared once per run.
+BENCHMARK_METRICS = (
+    ("rtf", False),
+    ("first_chunk_ms", False),
+    ("cpu_seconds", False),
+    ("chunks_per_second", True),
+)
+
+def get_peak_rss():
+    """ Returns peak resident set size of the process in kB or None """
+    try:
+        import resource
+    except ImportError:  # Windows
+        return None
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == "darwin":
+        rss //= 1024  # bytes there
+    return rss
+
+def get_cpu_time():
+    """ Returns user+system CPU seconds used by the process """
+    times = os.times()
+    return times[0] + times[1]
+
+class BenchmarkCallback(SpeechCallback):
+    """ Callback that counts chunks and samples and times the first one """
+    def __init__(self):
+        self.chunks = 0
+        self.samples = 0
+        self.first_chunk = None
+        self.starttime = clock()
+
+    def __call__(self, samples, count, user_data):
+        if self.first_chunk is None:
+            self.first_chunk = clock() - self.starttime
+        self.chunks += 1
+        self.samples += count
+        return True
+
+def median(values):
+    values = sorted(values)
+    middle = len(values) // 2
+    if len(values) % 2:
+        return values[middle]
+    return (values[middle-1] + values[middle]) / 2.0
+
+def benchmark_voice(engine, voice, texts, sample_rate=16000, repeat=3):
+    """
+    Speaks each of texts (BENCHMARK_CORPUS items) repeat times with
+    voice and returns dictionary of metrics for every text and for
+    all of them together. One message is spoken before measuring, so
+    loading voice data is not counted.
+
+    rtf is synthesis time divided by duration of audio (less than 1
+    is faster than real time), first_chunk_ms is median time until the
+    first audio callback.
+    """
+    params = new_synth_params(voice)
+    engine.speak(texts[0][2], params, SpeechCallback(), texts[0][1])
+
+    def measure(items):
+        callbacks = []
+        cpu = get_cpu_time()
+        starttime = clock()
+        for name, message_type, text in items:
+            for i in range(repeat):
+                callback = BenchmarkCallback()
+                if not engine.speak(text, params, callback, message_type):
+                    raise RuntimeError("RHVoice: %s failed to speak %s text" % (voice, name))
+                callbacks.append(callback)
+        elapsed = clock() - starttime
+        cpu = get_cpu_time() - cpu
+        audio = sum(c.samples for c in callbacks) / float(sample_rate)
+        chunks = sum(c.chunks for c in callbacks)
+        first_chunks = [c.first_chunk for c in callbacks if c.first_chunk is not None]
+        return dict(
+            messages=len(callbacks),
+            audio_seconds=round(audio, 3),
+            wall_seconds=round(elapsed, 4),
+            rtf=round(elapsed / audio, 4) if audio else None,
+            first_chunk_ms=round(median(first_chunks)*1000, 2) if first_chunks else None,
+            first_chunk_max_ms=round(max(first_chunks)*1000, 2) if first_chunks else None,
+            cpu_seconds=round(cpu, 3),
+            chunks=chunks,
+            chunks_per_second=round(chunks / elapsed, 1) if elapsed else None)
+
+    result = measure(texts)
+    result["texts"] = dict((item[0], measure([item])) for item in texts)
+    return result
+
+def run_benchmark(datadir=None, voices=None, repeat=3):
+    """
+    Measures every installed voice (or the ones named in voices) over
+    BENCHMARK_CORPUS for its language with benchmark_voice(). Returns
+    report, which can be saved as JSON and passed to
+    compare_benchmark() later. Memory can't be attributed to single
+    voices sharing the process, so peak_rss_kb is the process peak
+    after all of them.
+    """
+    import platform
+    if datadir is None:
+        datadir = get_datadir_location()
+    resources = find_resources(datadir)
+    report = dict(rhvoice=to_text(get_rhvoice_version()),
+                  python=platform.python_version(),
+                  platform=platform.platform(),
+                  repeat=repeat, voices=dict())
+    wanted = set(v.lower() for v in voices or ())
+    with Engine(datadir) as engine:
+        for voice in sorted(get_voices(engine).values(), key=lambda v: v["no"]):
+            name = to_text(voice["name"])
+            if wanted and name.lower() not in wanted:
+                continue
+            language = resources.get(("voice", name.lower()), {}).get("language", "")
+            texts = BENCHMARK_CORPUS.get(language)
+            if texts is None:
+                print("Skipped: %s, no texts for %s language" % (name, language))
+                continue
+            result = benchmark_voice(engine, name, texts,
+                                     get_sample_rate(name, resources), repeat)
+            result["language"] = language
+            report["voices"][name] = result
+    report["peak_rss_kb"] = get_peak_rss()
+    return report
+
+def compare_benchmark(report, baseline, tolerance=0.1):
+    """
+    Returns list of (voice, metric, baseline value, value) for
+    BENCHMARK_METRICS which got worse than in baseline by more than
+    tolerance (a fraction of the baseline value). Voices missing from
+    baseline are not compared, voices missing from report are
+    reported as "voice" regressions. peak_rss_kb of the run is
+    reported with voice "*", and only compared if both reports
+    measured the same voices.
+    """
+    regressions = []
+    for name, old in sorted(baseline["voices"].items()):
+        new = report["voices"].get(name)
+        if new is None:
+            regressions.append((name, "voice", "present", "missing"))
+            continue
+        for metric, higher_is_better in BENCHMARK_METRICS:
+            old_value, new_value = old.get(metric), new.get(metric)
+            if not old_value or new_value is None:
+                continue
+            change = (new_value - old_value) / float(old_value)
+            if higher_is_better:
+                change = -change
+            if change > tolerance:
+                regressions.append((name, metric, old_value, new_value))
+    old_value, new_value = baseline.get("peak_rss_kb"), report.get("peak_rss_kb")
+    if (old_value and new_value is not None
+            and sorted(baseline["voices"]) == sorted(report["voices"])
+            and (new_value - old_value) / float(old_value) > tolerance):
+        regressions.append(("*", "peak_rss_kb", old_value, new_value))
+    return regressions
+
+def print_benchmark(report):
+    print("  %-12s %8s %10s %8s %10s" % ("voice", "rtf", "first ms", "cpu s", "chunks/s"))
+    for name, result in sorted(report["voices"].items()):
+        print("  %-12s %8s %10s %8s %10s" % (
+            name, result["rtf"], result["first_chunk_ms"], result["cpu_seconds"],
+            result["chunks_per_second"]))
+    print("  peak RSS of the run: %s kB" % report.get("peak_rss_kb"))
+
+
+# --- batch mode ---
+
+MANIFEST_COLUMNS = ("output", "voice", "rate", "pitch", "volume", "text")
+
+def read_manifest(filename):
+    """
+    Reads batch manifest and yields its entries as dictionaries with
+    "output", "text" or "ssml", and optional "voice", "rate", "pitch"
+    and "volume" keys.
+
+    .jsonl (or .json) manifest has one JSON object per line. Any other
+    file is read as TSV with MANIFEST_COLUMNS, where empty columns
+    take default values and text starting with <speak> is SSML.
+    Empty lines and lines starting with # are skipped.
+    """
+    is_json = filename.lower().endswith((".jsonl", ".json"))
+    with open(filename, "rb") as f:
+        for lineno, line in enumerate(f, 1):
+            line = line.decode("utf-8").rstrip("\r\n")
+            if not line.strip() or line.startswith("#"):
+                continue
+            if is_json:
+                entry = json.loads(line)
+            else:
+                columns = line.split("\t", len(MANIFEST_COLUMNS)-1)
+                if len(columns) != len(MANIFEST_COLUMNS):
+                    raise ValueError("%s:%d: expected %d tab separated columns" % (filename, lineno, len(MANIFEST_COLUMNS)))
+                entry = dict((k, v) for k, v in zip(MANIFEST_COLUMNS, columns) if v)
+                if entry.get("text", "").lstrip().startswith("<speak"):
+                    entry["ssml"] = entry.pop("text")
+            if "output" not in entry or not ("text" in entry or "ssml" in entry):
+                raise ValueError("%s:%d: output and text or ssml are required" % (filename, lineno))
+            yield entry
+
+def run_batch(engine, entries, voice, rate=1.0, pitch=1.0, volume=1.0):
+    """
+    Renders manifest entries to their outputs with one engine. voice,
+    rate, pitch and volume are defaults for entries without them.
+    Entry with the same text and parameters as an earlier one is not
+    synthesized again - its output is copied from the earlier one.
+    Returns number of entries that failed.
+    """
+    profiles = dict((p.lower(), p) for p in get_voice_profiles(engine))
+    rendered = dict()
+    total = duplicates = errors = 0
+    seconds = 0.0
+    starttime = time.time()
+    for entry in entries:
+        total += 1
+        output = entry["output"]
+        name = entry.get("voice", voice)
+        profile = profiles.get(name.lower())
+        if profile is None:
+            print("Error: %s: voice %s is unknown" % (output, name))
+            errors += 1
+            continue
+        if "ssml" in entry:
+            text, message_type = entry["ssml"], RHVoice_message_type.ssml
+        else:
+            text, message_type = entry["text"], RHVoice_message_type.text
+        params = (float(entry.get("rate", rate)),
+                  float(entry.get("pitch", pitch)),
+                  float(entry.get("volume", volume)))
+        key = (message_type, text, profile) + params
+        if key in rendered:
+            if os.path.abspath(rendered[key]) != os.path.abspath(output):
+                shutil.copyfile(rendered[key], output)
+            duplicates += 1
+            if DEBUG:
+                print("Duplicate: %s (same as %s)" % (output, rendered[key]))
+            continue
+        sample_rate = engine.get_sample_rate(profile)
+        callback = WaveWriteCallback(output, sample_rate)
+        try:
+            engine.speak(text, new_synth_params(profile, *params),
+                         callback, message_type)
+        except RuntimeError as e:
+            print("Error: %s: %s" % (output, e))
+            errors += 1
+            continue
+        finally:
+            callback.close()
+        seconds += callback.samples / float(sample_rate)
+        rendered[key] = output
+        if DEBUG:
+            print("Written: %s" % output)
+    elapsed = time.time() - starttime
+    print("Entries: %d, synthesized: %d, duplicates: %d, errors: %d"
+          % (total, len(rendered), duplicates, errors))
+    print("Audio: %.1f s in %.1f s (%.1fx real time, %.1f entries/s)"
+          % (seconds, elapsed, seconds / elapsed if elapsed else 0,
+             total / elapsed if elapsed else 0))
+    return errors
+
+
+# --- streaming input ---
+
+SPLIT_MODES = ("line", "paragraph")
+
+def read_units(f, split="line"):
+    """
+    Yields lines or paragraphs (separated by empty lines) of UTF-8
+    text from binary file f, as soon as each of them is complete.
+    Empty units are skipped.
+    """
+    lines = []
+    for line in iter(f.readline, b""):
+        line = line.decode("utf-8", "replace").strip()
+        if split == "line" or not line:
+            if line:
+                yield line
+            elif lines:
+                yield " ".join(lines)
+            lines = []
+        else:
+            lines.append(line)
+    if lines:
+        yield " ".join(lines)
+
+def read_ahead(iterable, size=16):
+    """
+    Iterates over iterable in a thread, at most size items ahead of
+    the consumer, so reading overlaps with processing of the items.
+    """
+    items = Queue.Queue(size)
+    done = object()
+    errors = []
+    stopped = threading.Event()
+
+    def put(item):
+        # gives up once the consumer is gone
+        while not stopped.is_set():
+            try:
+                items.put(item, timeout=0.1)
+                return True
+            except Queue.Full:
+                pass
+        return False
+
+    def run():
+        try:
+            for item in iterable:
+                if not put(item):
+                    return
+        except Exception as e:
+            errors.append(e)
+        put(done)
+
+    thread = threading.Thread(target=run)
+    thread.daemon = True
+    thread.start()
+    try:
+        while True:
+            item = items.get()
+            if item is done:
+                if errors:
+                    raise errors[0]
+                break
+            yield item
+    finally:
+        # the thread may be blocked reading iterable (e.g. stdin), so
+        # it is not joined: it exits by itself or with the process
+        stopped.set()
+        try:
+            items.get_nowait()
+        except Queue.Empty:
+            pass
+
+def speak_units(engine, units, synth_params, callback):
+    """
+    Speaks every text of units as its own message to the same
+    callback, reading the next ones meanwhile. Stops if the library
+    fails to speak one of them (e.g. callback stopped synthesis).
+    Returns number of spoken units.
+    """
+    spoken = 0
+    for text in read_ahead(units):
+        if not engine.speak(text, synth_params, callback):
+            break
+        spoken += 1
+    return spoken
+
+
+# --- synthesis host ---
+
+class RingBuffer(object):
+    """
+    Queue of (kind, generation, data) records in a memory mapped file,
+    for one writer and one reader, which may be different processes.
+    The file starts with write and read positions, which only grow,
+    followed by capacity bytes of records. Records never overwrite
+    data that has not been read, put() waits for space instead.
+    """
+    audio = 1
+    mark = 2
+    done = 3
+
+    record = struct.Struct("<III")  # kind, generation, size of data
+    poll_interval = 0.002
+
+    def __init__(self, path, capacity=None):
+        import mmap
+        positions_size = sizeof(c_uint64)*2
+        if capacity is not None:
+            with open(path, "wb") as f:
+                f.write(b"\0"*(positions_size + capacity))
+        self.file = open(path, "r+b")
+        self.map = mmap.mmap(self.file.fileno(), 0)
+        # aligned 64 bit stores, so the other side never sees half of a position
+        self.positions = (c_uint64*2).from_buffer(self.map)
+        self.start = positions_size
+        self.capacity = len(self.map) - positions_size
+
+    def close(self):
+        del self.positions
+        self.map.close()
+        self.file.close()
+
+    def write_at(self, position, data):
+        offset = position % self.capacity
+        head = min(len(data), self.capacity - offset)
+        self.map[self.start+offset:self.start+offset+head] = data[:head]
+        if head < len(data):
+            self.map[self.start:self.start+len(data)-head] = data[head:]
+
+    def read_at(self, position, size):
+        offset = position % self.capacity
+        head = min(size, self.capacity - offset)
+        data = self.map[self.start+offset:self.start+offset+head]
+        if head < size:
+            data += self.map[self.start:self.start+size-head]
+        return data
+
+    def put(self, kind, generation, data=b"", stopped=None):
+        """
+        Appends record, waiting while the buffer is full. Returns False
+        without writing if stopped() becomes true meanwhile.
+        """
+        size = self.record.size + len(data)
+        if size > self.capacity:
+            raise ValueError("RHVoice: record is larger than ring buffer")
+        write_position = self.positions[0]
+        while write_position + size - self.positions[1] > self.capacity:
+            if stopped is not None and stopped():
+                return False
+            time.sleep(self.poll_interval)
+        if isinstance(data, memoryview):
+            data = data.tobytes()
+        self.write_at(write_position, self.record.pack(kind, generation, len(data)) + data)
+        self.positions[0] = write_position + size
+        return True
+
+    def get(self):
+        """ Returns the oldest record or None if there are none """
+        read_position = self.positions[1]
+        if read_position == self.positions[0]:
+            return None
+        kind, generation, size = self.record.unpack(self.read_at(read_position, self.record.size))
+        data = self.read_at(read_position + self.record.size, size)
+        self.positions[1] = read_position + self.record.size + size
+        return kind, generation, data
+
+
+class HostCallback(SpeechCallback):
+    """ Callback that writes speech and marks of a host message to RingBuffer """
+    def __init__(self, ring, generation, get_generation):
+        self.ring = ring
+        self.generation = generation
+        self.get_generation = get_generation
+
+    def stopped(self):
+        return self.get_generation() != self.generation
+
+    def __call__(self, samples, count, user_data):
+        return self.ring.put(RingBuffer.audio, self.generation,
+                             self.samples_view(samples, count), self.stopped)
+
+    def process_mark(self, name):
+        return self.ring.put(RingBuffer.mark, self.generation, name, self.stopped)
+
+
+def run_host(ring_path, stdin=None, stdout=None):
+    """
+    Runs synthesis for a client in another process (the NVDA driver).
+    The first line of stdin is JSON with Engine arguments, the answer
+    on stdout is JSON with "version", "voices" ([name, language]
+    pairs) and "profiles". After that every line of stdin is a
+    command:
+
+      {"cmd": "speak", "id": 1, "generation": 0, "text": "<speak>...",
+       "profile": "Alan", "rate": 0.0, "pitch": 0.0, "volume": 0.0}
+      {"cmd": "warm_up", "profile": "Alan"}
+      {"cmd": "cancel", "generation": 1}
+      {"cmd": "quit"}
+
+    rate, pitch and volume are absolute values. Speech and marks of
+    SSML messages go to RingBuffer in ring_path, followed by a done
+    record with the id. cancel drops messages of older generations and
+    stops the current one.
+    """
+    stdin = stdin or getattr(sys.stdin, "buffer", sys.stdin)
+    stdout = stdout or getattr(sys.stdout, "buffer", sys.stdout)
+    init = json.loads(stdin.readline().decode("utf-8"))
+    engine = Engine(init.get("datadir"), init.get("config_path"), init.get("resource_paths"),
+                    audio_buffer_size=init.get("audio_buffer_size"))
+    voices = get_voices(engine)
+    info = dict(version=to_text(get_rhvoice_version()),
+                voices=[[to_text(v["name"]), to_text(v["lang"])]
+                        for v in sorted(voices.values(), key=lambda v: v["no"])],
+                profiles=[to_text(p) for p in get_voice_profiles(engine)])
+    stdout.write(json.dumps(info).encode("utf-8") + b"\n")
+    stdout.flush()
+    ring = RingBuffer(ring_path)
+    commands = Queue.Queue()
+    state = dict(generation=0)
+
+    def read_commands():
+        for line in iter(stdin.readline, b""):
+            command = json.loads(line.decode("utf-8"))
+            if command["cmd"] == "cancel":
+                state["generation"] = command["generation"]
+                engine.cancel()
+            else:
+                commands.put(command)
+        commands.put(dict(cmd="quit"))
+
+    reader = threading.Thread(target=read_commands)
+    reader.daemon = True
+    reader.start()
+    try:
+        while True:
+            command = commands.get()
+            if command["cmd"] == "quit":
+                break
+            if command["cmd"] == "warm_up":
+                engine.warm_up([command["profile"]])
+                continue
+            generation = command["generation"]
+            if generation != state["generation"]:
+                continue
+            params = new_synth_params(command["profile"])
+            params.absolute_rate = command.get("rate", 0.0)
+            params.absolute_pitch = command.get("pitch", 0.0)
+            params.absolute_volume = command.get("volume", 0.0)
+            callback = HostCallback(ring, generation, lambda: state["generation"])
+            try:
+                engine.speak(command["text"], params, callback, RHVoice_message_type.ssml)
+            except RuntimeError as e:
+                sys.stderr.write("RHVoice host: %s\n" % e)
+            ring.put(RingBuffer.done, generation, str(command["id"]).encode("ascii"),
+                     callback.stopped)
+    finally:
+        ring.close()
+        engine.close()
+
 
 def main():
     global DEBUG
@@ -325,21 +2112,49 @@ Usage:
   1. RHVoice.py <command>
   2. RHVoice.py [--debug] [-o output.wav] \"text\"
   3. RHVoice.py [--debug] [-o output.wav] -i input.txt
+  4. RHVoice.py [--debug] --batch manifest.jsonl
+  5. RHVoice.py --benchmark report.json [--compare baseline.json]
+  6. RHVoice.py --host ring.bin
 
 Commands:
   list          - list voices loaded from datadir
   version       - show version of C module and Python API
 
 Options:
-  -i --input FILE       file with text encoded in UTF-8
-  -o --output FILE      output filename (default: output.wav)
+  -i --input FILE       file with text encoded in UTF-8, - is stdin
+  --split MODE          speak every line or paragraph of input as
+                        soon as it is read: line or paragraph
+  -o --output FILE      output filename (default: output.wav),
+                        - writes to stdout
+  --format FORMAT       wav, raw (16 bit mono PCM) or wav-stream (WAV
+                        header without length), the last two are
+                        written as speech is synthesized (default:
+                        wav, wav-stream for stdout)
+  --batch FILE          render every entry of JSONL/TSV manifest with
+                        one engine, --voice/--pitch/--rate/--volume
+                        are defaults for its entries
 
   --voice NAME[,NAME]   choose voices
   --pitch 1.0           tone of voice
   --rate 1.0            speed of speech
   --volume 1.0          speech volume
+  --buffer-ms 100       milliseconds of speech per callback, 0 for
+                        whole sentences (fewer calls, later audio)
 
   --datadir DATADIR     path to language data (default: RHVoice.langdata/)
+  --profile-startup     show time spent loading library, engine,
+                        every language and voice
+  --benchmark FILE      measure real-time factor, time to first audio,
+                        CPU time and chunks/s of every voice (or --voice
+                        ones) and peak RSS of the run, save them to FILE
+                        as JSON
+  --compare FILE        with --benchmark, exit with error if results
+                        are worse than in saved report FILE
+  --repeat 3            times each benchmark text is spoken
+  --tolerance 0.1       allowed relative difference from --compare
+  --host FILE           synthesize for another process, which sends
+                        commands to stdin and reads speech from ring
+                        buffer FILE (see run_host())
   --debug               show debug info
 """
 
@@ -360,8 +2175,14 @@ Options:
     parser = optparse.OptionParser()
     parser.add_option("-i", "--input",
                       help="file with text encoded in UTF-8")
+    parser.add_option("--split", choices=SPLIT_MODES,
+                      help="speak input line by line or paragraph by paragraph")
     parser.add_option("-o", "--output", default="output.wav",
                       help="output filename (default: output.wav)")
+    parser.add_option("--format", choices=sorted(OUTPUT_FORMATS),
+                      help="wav, raw or wav-stream")
+    parser.add_option("--batch",
+                      help="render every entry of JSONL/TSV manifest")
     parser.add_option("--datadir",
                       help="path to language data (default: RHVoice.langdata/)")
 
@@ -369,10 +2190,28 @@ Options:
     parser.add_option("--pitch", type="float", default=1.0, help="tone of voice")
     parser.add_option("--rate", type="float", default=1.0, help="speed of speech")
     parser.add_option("--volume", type="float", default=1.0, help="speech volume")
-
+    parser.add_option("--buffer-ms", type="int",
+                      help="milliseconds of speech per callback, 0 for whole sentences")
+
+    parser.add_option("--profile-startup", action="store_true",
+                      help="show time spent loading library, engine, every language and voice")
+    parser.add_option("--benchmark",
+                      help="measure every voice and save results as JSON")
+    parser.add_option("--compare",
+                      help="compare --benchmark results with saved report")
+    parser.add_option("--repeat", type="int", default=3,
+                      help="times each benchmark text is spoken")
+    parser.add_option("--tolerance", type="float", default=0.1,
+                      help="allowed relative difference from --compare")
+    parser.add_option("--host",
+                      help="synthesize commands from stdin into ring buffer file")
     parser.add_option("--debug", help="show debug info", action="store_true")
     opts, args = parser.parse_args()
-    if not args and not opts.input:
+    if opts.host:
+        run_host(opts.host)
+        sys.exit(0)
+    if (not args and not opts.input and not opts.batch
+            and not opts.profile_startup and not opts.benchmark):
         #parser.print_help()
         print(usage)
         print("\nError: No input text")
@@ -381,6 +2220,16 @@ Options:
     if opts.debug:
         DEBUG = 1
 
+    # speech goes to stdout, messages to stderr
+    stdout = None
+    if opts.output == "-":
+        stdout = get_binary_stdout()
+        sys.stdout = sys.stderr
+    output_format = opts.format or ("wav-stream" if stdout else "wav")
+    if stdout and output_format == "wav":
+        print("\nError: wav format needs seekable file, use wav-stream or raw")
+        sys.exit(-1)
+
     data_path = get_datadir_location()
     if opts.datadir:
         data_path = opts.datadir
@@ -396,13 +2245,37 @@ Options:
         print("    %s" % data_path)
         print("")
 
-    engine = init_rhvoice(datadir=data_path, callback=WaveWriteCallback(opts.output))
-    if not engine:
+    if opts.profile_startup:
+        print("Startup profile")
+        print_startup_profile(profile_startup(data_path))
+        sys.exit(0)
+
+    if opts.benchmark:
+        voices = opts.voice.split(",") if opts.voice else None
+        report = run_benchmark(data_path, voices, opts.repeat)
+        with open(opts.benchmark, "w") as f:
+            json.dump(report, f, indent=2, sort_keys=True)
+        print("Benchmark (RHVoice %s)" % report["rhvoice"])
+        print_benchmark(report)
+        if opts.compare:
+            with open(opts.compare) as f:
+                baseline = json.load(f)
+            regressions = compare_benchmark(report, baseline, opts.tolerance)
+            for name, metric, old, new in regressions:
+                print("Regression: %s %s %s -> %s" % (name, metric, old, new))
+            if regressions:
+                sys.exit(1)
+            print("No regressions against %s" % opts.compare)
+        sys.exit(0)
+
+    get_library().RHVoice_set_logging(True)
+    try:
+        engine = Engine(datadir=data_path, audio_buffer_size=opts.buffer_ms)
+    except RuntimeError:
         if DEBUG:
-            raise RuntimeError("RHVoice: engine initialization error")
+            raise
         else:
             sys.exit("RuntimeError: RHVoice: engine initialization error")
-    print("Writing to: %s" % opts.output)
 
     # --- voice ---
     # [ ] multiple voice selection (profile) is not there yet
@@ -446,30 +2319,29 @@ Options:
             print("Number of voices: %s" % len(voices))
         sys.exit(0)
 
+    # --- batch ---
+    if opts.batch:
+        errors = run_batch(engine, read_manifest(opts.batch),
+                           voice_selected_name[0],
+                           opts.rate, opts.pitch, opts.volume)
+        sys.exit(1 if errors else 0)
 
-
-    lib = LIB
-
-    profiles_total = lib.RHVoice_get_number_of_voice_profiles(engine)
-    profiles = []
-    first_profile = lib.RHVoice_get_voice_profiles(engine)
-    for profno in range(profiles_total):
-            profiles.append(first_profile[profno])
+    profiles = get_voice_profiles(engine)
     if DEBUG:
         print("Voice Profiles")
         for p in profiles:
             print(" %s" % p)
 
-    # transform text to RHVoice_message for RHVoice_speak 
-    # RHVoice_new_message is a function to do so. Its parameters:
-    # (RHVoice_tts_engine, c_char_p, c_uint, c_int, POINTER(RHVoice_synth_params), c_void_p)
-    # (tts_engine, const char* text, length, RHVoice_message_type,   synth_params, void* user_data)
-
-    text = ""
+    infile = None
+    stdin = getattr(sys.stdin, "buffer", sys.stdin)
     if args:
-        text += args[0]
+        text = args[0]
+    elif opts.input == "-":
+        infile = stdin
     else:
-        text += open(opts.input, "rb").read()
+        infile = open(opts.input, "rb")
+    if infile and not opts.split:
+        text = infile.read()
 
     # message also specifies voice parameters, which are obligatory
     synth_params = RHVoice_synth_params()
@@ -486,17 +2358,28 @@ Options:
     # (measured in Audacity)
     synth_params.relative_volume = opts.volume
 
-    message = lib.RHVoice_new_message(engine,
-                                      text,
-                                      len(text),
-                                      RHVoice_message_type.text,
-                                      byref(synth_params),
-                                      None)
-
-    if not message:
-        raise RuntimeError("RHVoice: message building error")
-    lib.RHVoice_speak(message)
-    lib.RHVoice_delete_message(message)  # free the memory (check when message is stored)
+    sample_rate = engine.get_sample_rate(synth_params.voice_profile)
+    print("Writing to: %s" % opts.output)
+    if output_format == "wav":
+        callback = WaveWriteCallback(opts.output, sample_rate)
+        output = None
+    else:
+        output = stdout or open(opts.output, "wb")
+        callback = OUTPUT_FORMATS[output_format](output, sample_rate)
+    try:
+        if infile and opts.split:
+            speak_units(engine, read_units(infile, opts.split),
+                        synth_params, callback)
+        else:
+            engine.speak(text, synth_params, callback)
+    finally:
+        callback.close()
+        if output and output is not stdout:
+            output.close()
+        if infile and infile is not stdin:
+            infile.close()
+    if getattr(callback, "error", None) is not None:
+        sys.exit("Error: writing to %s failed: %s" % (opts.output, callback.error))
 
 if __name__ == '__main__':
     main()
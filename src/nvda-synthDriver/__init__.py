@@ -15,9 +15,15 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 import os.path
+import re
 import Queue
-from collections import OrderedDict,defaultdict
+from collections import OrderedDict,defaultdict,deque
+import itertools
+import json
+import subprocess
+import tempfile
 import threading
+import time
 from ctypes import c_char_p,c_short,sizeof,string_at,byref,cast
 
 from RHVoice import RHVoice_tts_engine
@@ -25,6 +31,8 @@ from RHVoice import RHVoice_init_params, RHVoice_callback_types, RHVoice_callbac
 from RHVoice import RHVoice_synth_params
 from RHVoice import RHVoice_message_type, RHVoice_punctuation_mode, RHVoice_capitals_mode
 from RHVoice import load_tts_library, get_library_location
+from RHVoice import SpeechCallback, SpeechRecorder, SynthesisCache, LatencyCounter, find_resources, get_data_version
+from RHVoice import RingBuffer
 
 import config
 import nvwave
@@ -36,6 +44,18 @@ import addonHandler
 
 config_path=os.path.join(config.getUserDefaultConfigPath(),"RHVoice-config")
 
+# Warm up every voice profile after the current one, not only the voices which are selected
+warm_up_all_profiles=False
+
+# Python interpreter which runs synthesis in a separate process, e.g. r"C:\Python27\python.exe",
+# None synthesizes in NVDA process
+host_python=None
+
+# Milliseconds of speech passed to the driver at once, 0 for whole sentences, None keeps the library default.
+# Larger values mean fewer Python calls, but later first audio and less exact lastIndex:
+# it is the last mark queued to nvwave, so it runs ahead of playback by about the chunk nvwave holds.
+audio_buffer_size=None
+
 def escape_text(text):
     parts=list()
     for c in text:
@@ -56,55 +76,300 @@ def escape_text(text):
         parts.append(part)
     return u"".join(parts)
 
+# Characters of each language which are rendered in advance for spelling and typing echo
+alphabets={
+    "en":u"abcdefghijklmnopqrstuvwxyz",
+    "eo":u"abcĉdefgĝhĥijĵklmnoprsŝtuŭvz",
+    "ru":u"абвгдеёжзийклмнопрстуфхцчшщъыьэюя",
+    "ka":u"აბგდევზთიკლმნოპჟრსტუფქღყშჩცძწჭხჯჰ",
+}
+common_characters=u"0123456789 .,;:!?'\"-+=*/\\()[]{}<>@#$%^&_`~|"
+
+sentence_end_re=re.compile(u"(?<=[.!?\u2026])\\s+",re.UNICODE)
+
+class ssml_chunker(object):
+    """Splits a speech sequence into SSML documents at sentence ends and index marks, each one is spoken as a separate message."""
+    def __init__(self):
+        self.documents=list()
+        self.__language=None
+        self.__start()
+
+    def __start(self):
+        self.__parts=[u"<speak>"]
+        self.__empty=True
+        if self.__language is not None:
+            self.__parts.append(u'<voice xml:lang="{}">'.format(self.__language))
+
+    def split(self):
+        if self.__empty:
+            return
+        if self.__language is not None:
+            self.__parts.append(u"</voice>")
+        self.__parts.append(u"</speak>")
+        self.documents.append(u"".join(self.__parts))
+        self.__start()
+
+    def add_text(self,text,spell_mode=False):
+        if spell_mode:
+            self.__parts.append(u'<say-as interpret-as="characters">{}</say-as>'.format(escape_text(text)))
+            self.__empty=False
+            return
+        sentences=sentence_end_re.split(text)
+        for i,sentence in enumerate(sentences):
+            if sentence:
+                self.__parts.append(escape_text(sentence))
+                self.__empty=False
+            if i<len(sentences)-1:
+                self.split()
+
+    def add_mark(self,index):
+        # the mark starts the next message, so lastIndex changes when its audio reaches nvwave
+        self.split()
+        self.__parts.append(u'<mark name="%d"/>' % index)
+        self.__empty=False
+
+    def set_language(self,language):
+        if language==self.__language:
+            return
+        if self.__language is not None:
+            self.__parts.append(u"</voice>")
+        if language is not None:
+            self.__parts.append(u'<voice xml:lang="{}">'.format(language))
+        self.__language=language
+
+    def finish(self):
+        self.split()
+        return self.documents
+
+def character_message(character):
+    """The document SynthDriver.speak builds for one character in character mode."""
+    chunker=ssml_chunker()
+    chunker.add_text(character,True)
+    return chunker.finish()[0]
+
+character_message_re=re.compile(u'^<speak><say-as interpret-as="characters">(?:[^<&]|&[^;]+;)</say-as></speak>$',re.UNICODE)
+
+mark_re=re.compile(r'<mark name="(\d+)"/>')
+
+def strip_marks(text):
+    """Index numbers grow with every utterance, so messages are compared without them."""
+    return mark_re.sub("",text)
+
+class audio_player(threading.Thread):
+    """Plays audio and reports index marks in the order the synthesizer produced them, so the next message is synthesized while this one is playing. A mark is reported once the audio before it has been fed to nvwave, not when it has been heard."""
+    def __init__(self,player,cancel_flag,max_chunks=64):
+        self.__player=player
+        self.__cancel_flag=cancel_flag
+        self.__queue=Queue.Queue(max_chunks)
+        self.__generation=0
+        self.__lock=threading.Lock()
+        self.__index=None
+        threading.Thread.__init__(self)
+        self.daemon=True
+
+    @property
+    def index(self):
+        with self.__lock:
+            return self.__index
+
+    def __put(self,item):
+        # chunks produced before stop() are dropped by the generation check
+        generation=self.__generation
+        if self.__cancel_flag.is_set():
+            return False
+        self.__queue.put((generation,item))
+        return True
+
+    def feed(self,data):
+        return self.__put(data)
+
+    def mark(self,index):
+        return self.__put(index)
+
+    def stop(self):
+        self.__generation+=1
+        try:
+            while True:
+                self.__queue.get_nowait()
+        except Queue.Empty:
+            pass
+        self.__player.stop()
+
+    def pause(self,switch):
+        self.__player.pause(switch)
+
+    def close(self):
+        self.__queue.put(None)
+        self.join()
+        self.__player.close()
+
+    def run(self):
+        while True:
+            entry=self.__queue.get()
+            if entry is None:
+                break
+            generation,item=entry
+            if generation!=self.__generation:
+                continue
+            if isinstance(item,int):
+                with self.__lock:
+                    self.__index=item
+                continue
+            try:
+                self.__player.feed(item)
+            except:
+                log.debugWarning("Error feeding audio to nvWave",exc_info=True)
+
 class speech_callback(object):
     def __init__(self,lib,player,cancel_flag):
         self.__lib=lib
         self.__player=player
         self.__cancel_flag=cancel_flag
+        self.recorder=None
+        self.muted=False
 
     def __call__(self,samples,count,user_data):
         try:
             if self.__cancel_flag.is_set():
                 return 0
-            try:
-                self.__player.feed(string_at(samples,count*sizeof(c_short)))
-            except:
-                log.debugWarning("Error feeding audio to nvWave",exc_info=True)
-            return 1
+            if self.recorder is not None:
+                self.recorder(samples,count,user_data)
+            if self.muted:
+                return 1
+            return int(self.__player.feed(string_at(samples,count*sizeof(c_short))))
         except:
             log.error("RHVoice speech callback",exc_info=True)
             return 0
 
 class mark_callback(object):
+    def __init__(self,lib,player):
+        self.__lib=lib
+        self.__player=player
+
+    def __call__(self,name,user_data):
+        try:
+            return int(self.__player.mark(int(name)))
+        except:
+            log.error("RHVoice mark callback",exc_info=True)
+            return 0
+
+class replay_callback(SpeechCallback):
+    def __init__(self,speech_callback):
+        self.__speech_callback=speech_callback
+
+    def __call__(self,samples,count,user_data):
+        return self.__speech_callback(samples,count,user_data)
+
+class speech_cache(object):
+    """Replays short messages which have already been spoken with the same settings. Single characters are kept apart, so that long texts do not evict them. Index marks are not part of the key: ssml_chunker puts them before any text, so they are reported from the message itself before its cached audio."""
+    max_text_length=256
+
+    def __init__(self,speech_callback,mark_callback,resource_paths,max_bytes=16*1024*1024,max_character_bytes=16*1024*1024):
+        self.__speech_callback=speech_callback
+        self.__mark_callback=mark_callback
+        self.__replay_callback=replay_callback(speech_callback)
+        self.__cache=SynthesisCache(max_bytes)
+        self.__character_cache=SynthesisCache(max_character_bytes)
+        self.__resources=find_resources(None,resource_paths)
+        self.__data_versions=dict()
+        self.__key=None
+        self.__target=None
+        self.__recorder=None
+
+    def get_key(self,text,synth_params):
+        if len(text)>self.max_text_length:
+            return None
+        profile=synth_params.voice_profile
+        if profile not in self.__data_versions:
+            self.__data_versions[profile]=get_data_version(profile,self.__resources)
+        return self.__cache.make_key(strip_marks(text),RHVoice_message_type.ssml,synth_params,self.__data_versions[profile])
+
+    def is_character_message(self,text):
+        return character_message_re.match(strip_marks(text).decode("utf-8")) is not None
+
+    def get_cache(self,text):
+        if self.is_character_message(text):
+            return self.__character_cache
+        return self.__cache
+
+    def contains(self,text,synth_params):
+        key=self.get_key(text,synth_params)
+        return key is not None and key in self.get_cache(text)
+
+    def replay(self,text,synth_params):
+        key=self.get_key(text,synth_params)
+        if key is None:
+            return False
+        speech=self.get_cache(text).get(key)
+        if speech is None:
+            return False
+        for name in mark_re.findall(text):
+            if not self.__mark_callback(name,None):
+                return True
+        speech.replay(self.__replay_callback)
+        return True
+
+    def start_recording(self,text,synth_params):
+        self.__key=self.get_key(text,synth_params)
+        if self.__key is None:
+            return
+        self.__target=self.get_cache(text)
+        self.__recorder=SpeechRecorder()
+        self.__speech_callback.recorder=self.__recorder
+
+    def stop_recording(self,complete):
+        if self.__recorder is None:
+            return
+        self.__speech_callback.recorder=None
+        if complete:
+            self.__target.put(self.__key,self.__recorder.get_speech())
+        self.__key=None
+        self.__target=None
+        self.__recorder=None
+
+    def get_stats(self):
+        return self.__cache.get_stats()
+
+    def get_character_stats(self):
+        return self.__character_cache.get_stats()
+
+class message_canceller(object):
+    """Cancels the message being spoken in the library and measures how long it takes to stop."""
     def __init__(self,lib):
         self.__lib=lib
         self.__lock=threading.Lock()
-        self.__index=None
+        self.__msg=None
+        self.__cancel_time=None
+        self.latency=LatencyCounter()
 
-    @property
-    def index(self):
+    def start(self,msg):
         with self.__lock:
-            return self.__index
+            self.__msg=msg
 
-    @index.setter
-    def index(self,value):
+    def finish(self):
         with self.__lock:
-            self.__index=value
+            self.__msg=None
+            if self.__cancel_time is not None:
+                self.latency.add(time.time()-self.__cancel_time)
+                self.__cancel_time=None
 
-    def __call__(self,name,user_data):
-        try:
-            self.index=int(name)
-            return 1
-        except:
-            log.error("RHVoice mark callback",exc_info=True)
-            return 0
+    def cancel(self):
+        with self.__lock:
+            if self.__msg is None:
+                return
+            if self.__cancel_time is None:
+                self.__cancel_time=time.time()
+            if hasattr(self.__lib,"RHVoice_cancel"):
+                self.__lib.RHVoice_cancel(self.__msg)
 
 class speak_text(object):
-    def __init__(self,lib,tts_engine,text,cancel_flag):
+    def __init__(self,lib,tts_engine,text,cancel_flag,cache=None,canceller=None):
         self.__lib=lib
         self.__tts_engine=tts_engine
         self.__text=text.encode("utf-8")
         self.__cancel_flag=cancel_flag
+        self.__canceller=canceller
+        self.__cache=cache
         self.__synth_params=RHVoice_synth_params(voice_profile=None,
                                                  absolute_rate=0,
                                                  relative_rate=1,
@@ -128,9 +393,16 @@ class speak_text(object):
     def set_voice_profile(self,name):
         self.__synth_params.voice_profile=name
 
+    def is_cached(self):
+        return self.__cache is not None and self.__cache.contains(self.__text,self.__synth_params)
+
     def __call__(self):
         if self.__cancel_flag.is_set():
             return
+        if self.__cache is not None:
+            if self.__cache.replay(self.__text,self.__synth_params):
+                return
+            self.__cache.start_recording(self.__text,self.__synth_params)
         msg=self.__lib.RHVoice_new_message(self.__tts_engine,
                                            self.__text,
                                            len(self.__text),
@@ -138,19 +410,248 @@ class speak_text(object):
                                            byref(self.__synth_params),
                                            None)
         if msg:
+            if self.__canceller is not None:
+                self.__canceller.start(msg)
+                # cancel() might have been called before start()
+                if self.__cancel_flag.is_set():
+                    self.__canceller.cancel()
+            try:
+                self.__lib.RHVoice_speak(msg)
+            finally:
+                if self.__canceller is not None:
+                    self.__canceller.finish()
+                self.__lib.RHVoice_delete_message(msg)
+        if self.__cache is not None:
+            self.__cache.stop_recording(bool(msg) and not self.__cancel_flag.is_set())
+
+class warm_up(object):
+    """Speaks a throwaway message with the profile, so its data and synthesis instances are ready before the user needs them."""
+    text="123."
+
+    def __init__(self,lib,tts_engine,speech_callback,profile):
+        self.__lib=lib
+        self.__tts_engine=tts_engine
+        self.__speech_callback=speech_callback
+        self.__profile=profile
+
+    def __call__(self):
+        start_time=time.time()
+        synth_params=RHVoice_synth_params(voice_profile=self.__profile,
+                                          relative_rate=1,
+                                          relative_pitch=1,
+                                          relative_volume=1,
+                                          punctuation_mode=RHVoice_punctuation_mode.default,
+                                          capitals_mode=RHVoice_capitals_mode.default)
+        msg=self.__lib.RHVoice_new_message(self.__tts_engine,
+                                           self.text,
+                                           len(self.text),
+                                           RHVoice_message_type.text,
+                                           byref(synth_params),
+                                           None)
+        if not msg:
+            return
+        self.__speech_callback.muted=True
+        try:
             self.__lib.RHVoice_speak(msg)
+        finally:
+            self.__speech_callback.muted=False
             self.__lib.RHVoice_delete_message(msg)
+        log.info("RHVoice: warmed up {} in {:.0f} ms".format(self.__profile,(time.time()-start_time)*1000))
+
+class render_characters(object):
+    """Puts speech of single characters into the speech cache before they are typed or spelled. It renders one character at a time while nothing else is spoken, and gives up when the settings change."""
+    def __init__(self,tts_thread,speech_callback,new_task,get_settings,characters):
+        self.__tts_thread=tts_thread
+        self.__speech_callback=speech_callback
+        self.__new_task=new_task
+        self.__get_settings=get_settings
+        self.__settings=get_settings()
+        self.__characters=list(characters)
+        self.__start_time=time.time()
+
+    def __call__(self):
+        if self.__get_settings()!=self.__settings:
+            return
+        while self.__characters:
+            task=self.__new_task(character_message(self.__characters.pop()),self.__settings)
+            if task.is_cached():
+                continue
+            self.__speech_callback.muted=True
+            try:
+                task()
+            finally:
+                self.__speech_callback.muted=False
+            self.__tts_thread.add_idle_task(self)
+            return
+        log.debug("RHVoice: characters for {} rendered in {:.0f} ms".format(self.__settings,(time.time()-self.__start_time)*1000))
+
+class synthesis_host(object):
+    """Runs synthesis in a separate process (RHVoice.py --host). Commands go to its stdin, speech and marks come back through a ring buffer in a memory mapped file and are copied to the player."""
+    startup_timeout=15
+    exit_timeout=5
+
+    def __init__(self,python,player,config_path,resource_paths,capacity=1024*1024):
+        self.__player=player
+        self.__lock=threading.Lock()
+        self.__generation=0
+        self.__pending=0
+        self.__ids=itertools.count(1)
+        self.__busy=threading.Event()
+        self.__closed=False
+        self.__dead=False
+        self.__process=None
+        self.__ring=None
+        self.__ring_path=None
+        try:
+            fd,self.__ring_path=tempfile.mkstemp(prefix="RHVoice-",suffix=".ring")
+            os.close(fd)
+            self.__ring=RingBuffer(self.__ring_path,capacity)
+            script=os.path.join(os.path.dirname(os.path.abspath(__file__)),"RHVoice.py")
+            creationflags=0x08000000 if os.name=="nt" else 0 # CREATE_NO_WINDOW
+            self.__process=subprocess.Popen([python,script,"--host",self.__ring_path],stdin=subprocess.PIPE,stdout=subprocess.PIPE,creationflags=creationflags)
+            if not self.__send(dict(config_path=config_path,resource_paths=resource_paths,audio_buffer_size=audio_buffer_size)):
+                raise RuntimeError("RHVoice: cannot send settings to synthesis host")
+            info=self.__read_info()
+        except:
+            self.__clean_up()
+            raise
+        self.version=info["version"]
+        self.voices=[tuple(voice) for voice in info["voices"]]
+        self.profiles=info["profiles"]
+        log.info("RHVoice synthesis host {} started, pid {}".format(self.version,self.__process.pid))
+        self.__reader=threading.Thread(target=self.__read)
+        self.__reader.daemon=True
+        self.__reader.start()
+
+    def __read_info(self):
+        # readline can't time out, so it runs in a thread which is abandoned if the host hangs
+        lines=Queue.Queue()
+        reader=threading.Thread(target=lambda: lines.put(self.__process.stdout.readline()))
+        reader.daemon=True
+        reader.start()
+        try:
+            line=lines.get(timeout=self.startup_timeout)
+        except Queue.Empty:
+            raise RuntimeError("RHVoice: synthesis host has not started in {} s".format(self.startup_timeout))
+        if not line:
+            raise RuntimeError("RHVoice: synthesis host has exited during startup")
+        return json.loads(line.decode("utf-8"))
+
+    def __wait(self,timeout):
+        end_time=time.time()+timeout
+        while self.__process.poll() is None and time.time()<end_time:
+            time.sleep(0.05)
+        if self.__process.poll() is None:
+            try:
+                self.__process.kill()
+            except EnvironmentError:
+                pass
+            self.__process.wait()
+
+    def __clean_up(self):
+        if self.__process is not None:
+            self.__wait(0)
+        if self.__ring is not None:
+            self.__ring.close()
+        if self.__ring_path is not None:
+            try:
+                os.remove(self.__ring_path)
+            except EnvironmentError:
+                log.debugWarning("RHVoice: cannot remove {}".format(self.__ring_path),exc_info=True)
+
+    def __send(self,command):
+        if self.__dead:
+            return False
+        try:
+            self.__process.stdin.write(json.dumps(command).encode("utf-8")+b"\n")
+            self.__process.stdin.flush()
+            return True
+        except EnvironmentError:
+            log.error("RHVoice: synthesis host is not running",exc_info=True)
+            self.__dead=True
+            self.__busy.set()
+            return False
+
+    @property
+    def alive(self):
+        return not self.__dead and self.__process.poll() is None
+
+    def speak(self,text,settings):
+        """Returns False if the host is not running, the text has not been sent then."""
+        profile,rate,pitch,volume=settings
+        with self.__lock:
+            if not self.alive:
+                return False
+            self.__pending+=1
+            self.__busy.set()
+            return self.__send(dict(cmd="speak",id=next(self.__ids),generation=self.__generation,text=text,profile=profile,rate=rate/50.0-1,pitch=pitch/50.0-1,volume=volume/50.0-1))
+
+    def warm_up(self,profile):
+        with self.__lock:
+            self.__send(dict(cmd="warm_up",profile=profile))
+
+    def cancel(self):
+        with self.__lock:
+            self.__generation+=1
+            self.__pending=0
+            self.__send(dict(cmd="cancel",generation=self.__generation))
+
+    def close(self):
+        with self.__lock:
+            self.__send(dict(cmd="quit"))
+            self.__closed=True
+            self.__busy.set()
+        self.__wait(self.exit_timeout)
+        self.__reader.join()
+        self.__clean_up()
+
+    def __read(self):
+        while True:
+            record=self.__ring.get()
+            if record is None:
+                with self.__lock:
+                    if self.__closed:
+                        break
+                    if self.__process.poll() is not None:
+                        self.__dead=True
+                        break
+                    if self.__pending==0:
+                        self.__busy.clear()
+                self.__busy.wait()
+                time.sleep(RingBuffer.poll_interval)
+                continue
+            kind,generation,data=record
+            if generation!=self.__generation:
+                continue
+            if kind==RingBuffer.audio:
+                self.__player.feed(data)
+            elif kind==RingBuffer.mark:
+                self.__player.mark(int(data))
+            elif kind==RingBuffer.done:
+                with self.__lock:
+                    if generation==self.__generation:
+                        self.__pending=max(0,self.__pending-1)
 
 class TTSThread(threading.Thread):
     def __init__(self,tts_queue):
         self.__queue=tts_queue
+        self.__idle_tasks=deque()
         threading.Thread.__init__(self)
         self.daemon=True
 
+    def add_idle_task(self,task):
+        """The task runs when there is nothing to speak, cancel does not remove it."""
+        self.__idle_tasks.append(task)
+        # wake the thread up if it is waiting
+        self.__queue.put(lambda: None)
+
     def run(self):
         while True:
             try:
-                task=self.__queue.get()
+                try:
+                    task=self.__queue.get(block=not self.__idle_tasks)
+                except Queue.Empty:
+                    task=self.__idle_tasks.popleft()
                 if task is None:
                     break
                 else:
@@ -174,13 +675,41 @@ class SynthDriver(SynthDriver):
     def __init__(self):
         self.__lib=load_tts_library()
         self.__cancel_flag=threading.Event()
-        self.__player=nvwave.WavePlayer(channels=1,samplesPerSec=16000,bitsPerSample=16,outputDevice=config.conf["speech"]["outputDevice"])
+        self.__player=audio_player(nvwave.WavePlayer(channels=1,samplesPerSec=16000,bitsPerSample=16,outputDevice=config.conf["speech"]["outputDevice"]),self.__cancel_flag)
+        self.__player.start()
         self.__speech_callback=speech_callback(self.__lib,self.__player,self.__cancel_flag)
         self.__c_speech_callback=RHVoice_callback_types.play_speech(self.__speech_callback)
-        self.__mark_callback=mark_callback(self.__lib)
+        self.__mark_callback=mark_callback(self.__lib,self.__player)
         self.__c_mark_callback=RHVoice_callback_types.process_mark(self.__mark_callback)
-        resource_paths=[os.path.join(addon.path,"data").encode("UTF-8") for addon in addonHandler.getRunningAddons() if (addon.name.startswith("RHVoice-language") or addon.name.startswith("RHVoice-voice"))]
-        c_resource_paths=(c_char_p*(len(resource_paths)+1))(*(resource_paths+[None]))
+        self.__resource_paths=[os.path.join(addon.path,"data").encode("UTF-8") for addon in addonHandler.getRunningAddons() if (addon.name.startswith("RHVoice-language") or addon.name.startswith("RHVoice-voice"))]
+        self.__tts_engine=None
+        self.__speech_cache=None
+        self.__canceller=None
+        self.__host=None
+        if host_python:
+            try:
+                self.__host=synthesis_host(host_python,self.__player,config_path,[path.decode("utf-8") for path in self.__resource_paths])
+            except:
+                log.error("RHVoice: cannot start synthesis host, speaking from NVDA process",exc_info=True)
+        self.__profile=None
+        if self.__host is not None:
+            # the voices are loaded by the host only
+            self.__set_voices(self.__host.voices,self.__host.profiles)
+        else:
+            self.__set_voices(*self.__start_engine())
+        self.__rate=50
+        self.__pitch=50
+        self.__volume=50
+        self.__tts_queue=Queue.Queue()
+        self.__tts_thread=TTSThread(self.__tts_queue)
+        self.__tts_thread.start()
+        self.__warm_up_profiles()
+        self.__render_characters()
+        log.info("Using RHVoice version {}".format(self.__lib.RHVoice_get_version()))
+
+    def __start_engine(self):
+        """Creates the engine in NVDA process and returns its voices as (name,language) pairs and its voice profiles."""
+        c_resource_paths=(c_char_p*(len(self.__resource_paths)+1))(*(self.__resource_paths+[None]))
         init_params=RHVoice_init_params(None,
                                         config_path.encode("utf-8"),
                                         c_resource_paths,
@@ -195,61 +724,121 @@ class SynthDriver(SynthDriver):
         self.__tts_engine=self.__lib.RHVoice_new_tts_engine(byref(init_params))
         if not self.__tts_engine:
             raise RuntimeError("RHVoice: initialization error")
-        nvda_language=languageHandler.getLanguage().split("_")[0]
+        if audio_buffer_size is not None:
+            self.__lib.RHVoice_set_audio_buffer_size(self.__tts_engine,audio_buffer_size)
+        self.__speech_cache=speech_cache(self.__speech_callback,self.__mark_callback,self.__resource_paths)
+        self.__canceller=message_canceller(self.__lib)
         number_of_voices=self.__lib.RHVoice_get_number_of_voices(self.__tts_engine)
         native_voices=self.__lib.RHVoice_get_voices(self.__tts_engine)
-        self.__voice_languages=dict()
-        self.__languages=set()
-        for i in xrange(number_of_voices):
-            native_voice=native_voices[i]
-            self.__voice_languages[native_voice.name]=native_voice.language
-            self.__languages.add(native_voice.language)
-        self.__profile=None
-        self.__profiles=list()
+        voices=[(native_voices[i].name,native_voices[i].language) for i in xrange(number_of_voices)]
         number_of_profiles=self.__lib.RHVoice_get_number_of_voice_profiles(self.__tts_engine)
         native_profile_names=self.__lib.RHVoice_get_voice_profiles(self.__tts_engine)
-        for i in xrange(number_of_profiles):
-            name=native_profile_names[i]
-            self.__profiles.append(name)
-            if (self.__profile is None) and (nvda_language==self.__voice_languages[name.split("+")[0]]):
+        profiles=[native_profile_names[i] for i in xrange(number_of_profiles)]
+        return (voices,profiles)
+
+    def __set_voices(self,voices,profiles):
+        nvda_language=languageHandler.getLanguage().split("_")[0]
+        self.__voice_languages=dict(voices)
+        self.__languages=set(self.__voice_languages.values())
+        self.__profiles=list(profiles)
+        if self.__profile in self.__profiles:
+            # names from the host are unicode, the library wants bytes
+            self.__profile=self.__profiles[self.__profiles.index(self.__profile)]
+            return
+        self.__profile=None
+        for name in self.__profiles:
+            if nvda_language==self.__voice_languages[name.split("+")[0]]:
                 self.__profile=name
+                break
         if self.__profile is None:
             self.__profile=self.__profiles[0]
-        self.__rate=50
-        self.__pitch=50
-        self.__volume=50
-        self.__tts_queue=Queue.Queue()
-        self.__tts_thread=TTSThread(self.__tts_queue)
-        self.__tts_thread.start()
-        log.info("Using RHVoice version {}".format(self.__lib.RHVoice_get_version()))
+
+    def __check_host(self):
+        """Switches to synthesis in NVDA process if the host has exited."""
+        if self.__host is None or self.__host.alive:
+            return
+        log.error("RHVoice: synthesis host has exited, speaking from NVDA process")
+        self.__host.close()
+        self.__host=None
+        self.__set_voices(*self.__start_engine())
+        self.__warm_up_profiles()
+        self.__render_characters()
+
+    def __warm_up_profiles(self):
+        self.__warmed_up_profiles=set()
+        self.__warm_up(self.__profile)
+        if warm_up_all_profiles:
+            for profile in self.__profiles:
+                self.__warm_up(profile)
+
+    def __warm_up(self,profile):
+        if profile in self.__warmed_up_profiles:
+            return
+        self.__warmed_up_profiles.add(profile)
+        if self.__host is not None:
+            self.__host.warm_up(profile)
+            return
+        self.__tts_thread.add_idle_task(warm_up(self.__lib,self.__tts_engine,self.__speech_callback,profile))
+
+    def __get_settings(self):
+        return (self.__profile,self.__rate,self.__pitch,self.__volume)
+
+    def __new_task(self,text,settings):
+        profile,rate,pitch,volume=settings
+        task=speak_text(self.__lib,self.__tts_engine,text,self.__cancel_flag,self.__speech_cache,self.__canceller)
+        task.set_voice_profile(profile)
+        task.set_rate(rate)
+        task.set_pitch(pitch)
+        task.set_volume(volume)
+        return task
+
+    def __render_characters(self):
+        if self.__host is not None:
+            return
+        priorities=dict((c,1) for c in common_characters)
+        for name in self.__profile.split("+"):
+            alphabet=alphabets.get(self.__voice_languages[name],u"")
+            priorities.update((c,2) for c in alphabet.upper())
+            priorities.update((c,0) for c in alphabet)
+        # what speech.speakSpelling passes for a typed or spelled character
+        language=self.__voice_languages[self.__profile.split("+")[0]]
+        text=self.__build_documents([speech.LangChangeCommand(language),speech.CharacterModeCommand(True),speech.IndexCommand(1),u"a"])[0]
+        if not self.__speech_cache.is_character_message(text.encode("utf-8")):
+            log.debugWarning("RHVoice: characters NVDA speaks will not be found in the character cache: {}".format(text))
+        # small letters are rendered first, render_characters takes them from the end
+        characters=sorted(priorities,key=lambda c:(priorities[c],c),reverse=True)
+        self.__tts_thread.add_idle_task(render_characters(self.__tts_thread,self.__speech_callback,self.__new_task,self.__get_settings,characters))
 
     def terminate(self):
         self.cancel()
         self.__tts_queue.put(None)
         self.__tts_thread.join()
+        if self.__tts_engine is not None:
+            log.info("RHVoice speech cache: {}".format(self.__speech_cache.get_stats()))
+            log.info("RHVoice character cache: {}".format(self.__speech_cache.get_character_stats()))
+            log.info("RHVoice time from cancel to silence: {}".format(self.__canceller.latency.get_stats()))
+        if self.__host is not None:
+            self.__host.close()
         self.__player.close()
-        self.__lib.RHVoice_delete_tts_engine(self.__tts_engine)
-        self.__tts_engine=None
+        if self.__tts_engine is not None:
+            self.__lib.RHVoice_delete_tts_engine(self.__tts_engine)
+            self.__tts_engine=None
 
-    def speak(self,speech_sequence):
+    def __build_documents(self,speech_sequence):
         spell_mode=False
-        language_changed=False
-        text_list=[u"<speak>"]
+        chunker=ssml_chunker()
         for item in speech_sequence:
             if isinstance(item,basestring):
-                s=escape_text(unicode(item))
-                text_list.append((u'<say-as interpret-as="characters">{}</say-as>'.format(s)) if spell_mode else s)
+                chunker.add_text(unicode(item),spell_mode)
             elif isinstance(item,speech.IndexCommand):
-                text_list.append('<mark name="%d"/>' % item.index)
+                chunker.add_mark(item.index)
             elif isinstance(item,speech.CharacterModeCommand):
                 if item.state:
                     spell_mode=True
                 else:
                     spell_mode=False
             elif isinstance(item,speech.LangChangeCommand):
-                if language_changed:
-                    text_list.append(u"</voice>")
-                    language_changed=False
+                chunker.set_language(None)
                 if not item.lang:
                     continue
                 new_language=item.lang.split("_")[0]
@@ -257,37 +846,42 @@ class SynthDriver(SynthDriver):
                     continue
                 elif new_language==self.__voice_languages[self.__profile.split("+")[0]]:
                     continue
-                text_list.append(u'<voice xml:lang="{}">'.format(new_language))
-                language_changed=True
+                chunker.set_language(new_language)
             elif isinstance(item,speech.SpeechCommand):
                 log.debugWarning("Unsupported speech command: %s"%item)
             else:
                 log.error("Unknown speech: %s"%item)
-        if language_changed:
-            text_list.append(u"</voice>")
-        text_list.append(u"</speak>")
-        text=u"".join(text_list)
-        task=speak_text(self.__lib,self.__tts_engine,text,self.__cancel_flag)
-        task.set_voice_profile(self.__profile)
-        task.set_rate(self.__rate)
-        task.set_pitch(self.__pitch)
-        task.set_volume(self.__volume)
-        self.__tts_queue.put(task)
+        return chunker.finish()
+
+    def speak(self,speech_sequence):
+        self.__check_host()
+        settings=self.__get_settings()
+        for text in self.__build_documents(speech_sequence):
+            if (self.__host is not None) and (not self.__host.speak(text,settings)):
+                self.__check_host()
+            if self.__host is None:
+                self.__tts_queue.put(self.__new_task(text,settings))
 
     def pause(self,switch):
         self.__player.pause(switch)
 
     def cancel(self):
+        self.__check_host()
+        if self.__host is not None:
+            self.__host.cancel()
+            self.__player.stop()
+            return
         try:
             while True:
                 self.__tts_queue.get_nowait()
         except Queue.Empty:
             self.__cancel_flag.set()
+            self.__canceller.cancel()
             self.__tts_queue.put(self.__cancel_flag.clear)
             self.__player.stop()
 
     def _get_lastIndex(self):
-        return self.__mark_callback.index
+        return self.__player.index
 
     def _get_availableVoices(self):
         return OrderedDict((profile,VoiceInfo(profile,profile,self.__voice_languages[profile.split("+")[0]])) for profile in self.__profiles)
@@ -300,18 +894,21 @@ class SynthDriver(SynthDriver):
 
     def _set_rate(self,rate):
         self.__rate=max(0,min(100,rate))
+        self.__render_characters()
 
     def _get_pitch(self):
         return self.__pitch
 
     def _set_pitch(self,pitch):
         self.__pitch=max(0,min(100,pitch))
+        self.__render_characters()
 
     def _get_volume(self):
         return self.__volume
 
     def _set_volume(self,volume):
         self.__volume=max(0,min(100,volume))
+        self.__render_characters()
 
     def _get_voice(self):
         return self.__profile
@@ -320,4 +917,6 @@ class SynthDriver(SynthDriver):
         try:
             self.__profile=self.availableVoices[voice].ID
         except:
-            pass
+            return
+        self.__warm_up(self.__profile)
+        self.__render_characters()
@@ -19,98 +19,209 @@ import sys
 import codecs
 import collections
 import struct
+import array
 
-class state(object):
-	def __init__(self):
-		self.transitions=dict()
-		self.fail=0
-		self.next=0
-		self.word=None
-		self.data=None
+magic="RHAC"
+format_version=1
+no_state=0xffffffff
+max_tries=16
+
+def to_big_endian(a):
+	if sys.byteorder=="little":
+		a.byteswap()
+	return a
 
 class rules(object):
 	def __init__(self,file_path):
-		self.states=[state()]
+		entries=dict()
 		with codecs.open(file_path,"r","utf-8") as f:
 			for line in f:
 				entry=line.strip()
 				if entry:
 					word=entry.lower()
 					n=next(i for i in xrange(len(entry)) if entry[i].isupper())
-					self.add(word,n)
-		self.build()
+					entries[word]=n
+		self.alphabet=sorted(set(c for word in entries for c in word))
+		if len(self.alphabet)>=0xffff:
+			raise RuntimeError("The alphabet is too large")
+		self.codes=array.array("H",[0])*(sys.maxunicode+1)
+		for i,c in enumerate(self.alphabet):
+			self.codes[ord(c)]=i+1
+		self.build(sorted(entries.iteritems()))
 
-	def add(self,word,n):
-		s=0
-		for c in word:
-			if c in self.states[s].transitions:
-				s=self.states[s].transitions[c]
-			else:
-				self.states.append(state())
-				self.states[s].transitions[c]=len(self.states)-1
-				s=len(self.states)-1
-		self.states[s].data=n
-		self.states[s].word=word
+	def encode(self,word):
+		codes=self.codes
+		return [codes[ord(c)] for c in word]
+
+	def grow(self,size):
+		old_size=len(self.check)
+		extra=max(size-old_size,old_size//2,1024)
+		self.base.extend(array.array("I",[0])*extra)
+		self.check.extend(array.array("I",[no_state])*extra)
+		self.fail.extend(array.array("I",[0])*extra)
+		self.next.extend(array.array("I",[0])*extra)
+		self.lengths.extend(array.array("B",[0])*extra)
+		self.values.extend(array.array("I",[0])*extra)
+		# Free cells form a circular list through the root, which is never free
+		next_free=self.next_free
+		prev_free=self.prev_free
+		tail=prev_free[0]
+		next_free.extend(xrange(old_size+1,old_size+extra+1))
+		prev_free.extend(xrange(old_size-1,old_size+extra-1))
+		next_free[tail]=old_size
+		prev_free[old_size]=tail
+		next_free[-1]=0
+		prev_free[0]=len(next_free)-1
+		self.tries.extend([0]*extra)
+
+	def allocate(self,s,labels):
+		check=self.check
+		next_free=self.next_free
+		prev_free=self.prev_free
+		tries=self.tries
+		first=labels[0]
+		rest=labels[1:]
+		# Nodes with several children start at the scan cursor, which skips
+		# free cells that have been rejected too often. Single children still
+		# take the first free cell, so the skipped cells are not wasted.
+		t=next_free[self.scan_from if rest else 0]
+		while True:
+			if t==0:
+				t=len(check)
+				self.grow(t+labels[-1])
+				check=self.check
+			b=t-first
+			if b>=0:
+				size=len(check)
+				for c in rest:
+					u=b+c
+					if u<size and check[u]!=no_state:
+						break
+				else:
+					break
+			if rest:
+				tries[t]+=1
+				if tries[t]>=max_tries and prev_free[t]==self.scan_from:
+					self.scan_from=t
+			t=next_free[t]
+		if b+labels[-1]>=len(check):
+			self.grow(b+labels[-1]+1)
+			check=self.check
+		for c in labels:
+			u=b+c
+			check[u]=s
+			n=next_free[u]
+			p=prev_free[u]
+			next_free[p]=n
+			prev_free[n]=p
+			if u==self.scan_from:
+				self.scan_from=p
+		return b
 
 	def go_to(self,s,c):
-		t=s
+		base=self.base
+		check=self.check
 		while True:
-			if c in self.states[t].transitions:
-				t=self.states[t].transitions[c]
-				break
-			elif t==0:
-				break
-			else:
-				t=self.states[t].fail
-		return t
+			t=base[s]+c
+			if t<len(check) and check[t]==s:
+				return t
+			elif s==0:
+				return 0
+			s=self.fail[s]
 
-	def build(self):
-		q=collections.deque(self.states[0].transitions.itervalues())
+	def build(self,entries):
+		words=[self.encode(word) for word,n in entries]
+		self.base=array.array("I",[0])
+		self.check=array.array("I",[no_state])
+		self.fail=array.array("I",[0])
+		self.next=array.array("I",[0])
+		self.lengths=array.array("B",[0])
+		self.values=array.array("I",[0])
+		self.next_free=[0]
+		self.prev_free=[0]
+		self.tries=[0]
+		self.scan_from=0
+		q=collections.deque([(0,0,0,len(words))])
 		while q:
-			s=q.popleft()
-			for c,t in self.states[s].transitions.iteritems():
-				q.append(t)
-				f=self.go_to(self.states[s].fail,c)
-				self.states[t].fail=f
-				if self.states[f].data is not None:
-					self.states[t].next=f
-				else:
-					self.states[t].next=self.states[f].next
+			s,depth,lo,hi=q.popleft()
+			if len(words[lo])==depth:
+				lo+=1
+			if lo==hi:
+				continue
+			children=list()
+			start=lo
+			for i in xrange(lo+1,hi+1):
+				if i==hi or words[i][depth]!=words[start][depth]:
+					children.append((words[start][depth],start,i))
+					start=i
+			b=self.allocate(s,[c for c,first,last in children])
+			self.base[s]=b
+			for c,first,last in children:
+				t=b+c
+				if len(words[first])==depth+1:
+					if depth>=255:
+						raise RuntimeError("The rule is too long")
+					self.lengths[t]=depth+1
+					self.values[t]=entries[first][1]
+				f=0 if s==0 else self.go_to(self.fail[s],c)
+				self.fail[t]=f
+				self.next[t]=f if self.lengths[f] else self.next[f]
+				q.append((t,depth+1,first,last))
+		del self.next_free
+		del self.prev_free
+		del self.tries
+		size=len(self.check)
+		while self.check[size-1]==no_state:
+			size-=1
+		for a in (self.base,self.check,self.fail,self.next,self.lengths,self.values):
+			del a[size:]
 
-	def match(self,word):
-		matches=[None]*len(word)
+	def match_codes(self,codes):
+		base=self.base
+		check=self.check
+		fail=self.fail
+		size=len(check)
+		lengths=self.lengths
+		nxt=self.next
+		matches=[0]*len(codes)
 		s=0
-		for i in xrange(len(word)):
-			c=word[i]
-			s=self.go_to(s,c)
-			if self.states[s].data is not None:
-				o=s
-			else:
-				o=self.states[s].next
+		for i,c in enumerate(codes):
+			while True:
+				t=base[s]+c
+				if t<size and check[t]==s:
+					s=t
+					break
+				elif s==0:
+					break
+				s=fail[s]
+			o=s if lengths[s] else nxt[s]
 			while o!=0:
-				st=self.states[o]
-				matches[i+1-len(st.word)]=st
-				o=st.next
+				matches[i+1-lengths[o]]=o
+				o=nxt[o]
 		result=list()
 		i=0
 		while i<len(matches):
-			if matches[i] is not None:
-				st=matches[i]
-				result.append((i,len(st.word),st.data))
-				i+=len(st.word)
+			o=matches[i]
+			if o:
+				result.append((i,lengths[o],int(self.values[o])))
+				i+=lengths[o]
 			else:
 				i+=1
 		return result
 
+	def match(self,word):
+		return self.match_codes(self.encode(word))
+
+	def match_many(self,words):
+		for word in words:
+			yield self.match_codes(self.encode(word))
+
 	def save(self,file_path):
 		with open(file_path,"wb") as f:
-			f.write(struct.pack(">I",len(self.states)))
-			for st in self.states:
-				f.write(struct.pack(">B",len(st.transitions)))
-				for c,s in sorted(st.transitions.iteritems()):
-					f.write(struct.pack(">II",ord(c),s))
-				f.write(struct.pack(">II",st.fail,st.next))
-				if st.word is not None:
-					f.write(struct.pack(">BB",len(st.word),st.data))
-				else:
-					f.write(struct.pack(">B",0))
+			f.write(magic)
+			f.write(struct.pack(">3I",format_version,len(self.alphabet),len(self.check)))
+			to_big_endian(array.array("I",(ord(c) for c in self.alphabet))).tofile(f)
+			for a in (self.base,self.check,self.fail,self.next,self.values):
+				to_big_endian(array.array("I",a)).tofile(f)
+			self.lengths.tofile(f)
+			f.write("\x00"*(-len(self.lengths)%4))
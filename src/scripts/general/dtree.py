@@ -16,14 +16,29 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 import struct
+import re
+
+magic="RHDT"
+format_version=1
+number_flag=0x80000000
 
 operators={"is":1,"=":1,"<":2,">":3,"in":4}
 
+number_regex=re.compile(r"^(?:0|[1-9][0-9]*)$")
+
+# The core compares feature values as numbers when they look like
+# numbers, so question values are stored the same way. Answers keep
+# their type.
+def normalize(obj):
+	if isinstance(obj,unicode) and number_regex.match(obj):
+		return int(obj)
+	return obj
+
 def is_string(obj):
-	return (isinstance(obj,unicode) and (len(obj)>0) and (len(obj)<256))
+	return (isinstance(obj,unicode) and (len(obj)>0) and (u"\0" not in obj))
 
 def is_number(obj):
-	return (isinstance(obj,int) and (obj>=0) and (obj<256))
+	return (isinstance(obj,(int,long)) and (obj>=0) and (obj<number_flag-1))
 
 def is_single_value(obj):
 	return (is_string(obj) or is_number(obj))
@@ -37,7 +52,7 @@ def is_question(obj):
 	if len(obj)!=3:
 		return False
 	if not is_string(obj[0]):
-		return false
+		return False
 	if obj[1] in ["is","="]:
 		return is_single_value(obj[2])
 	elif obj[1] in ["<",">"]:
@@ -48,46 +63,103 @@ def is_question(obj):
 		return False
 
 def is_leaf(node):
-	return (isinstance(node,list) and len(node)==1 and isinstance(node[0],list) and is_single_value(node[0][-1]))
-
-def is_node(node):
-	return (is_leaf(node) or (isinstance(node,list) and len(node)==3 and is_question(node[0]) and is_node(node[1]) and is_node(node[2])))
-
-def write_single_value(dest,val,typed=False):
-	if isinstance(val,unicode):
-		if typed:
+	return (isinstance(node,list) and len(node)==1 and isinstance(node[0],list) and len(node[0])>0 and is_single_value(node[0][-1]))
+
+def is_internal_node(node):
+	return (isinstance(node,list) and len(node)==3 and is_question(node[0]))
+
+class string_table(object):
+	def __init__(self):
+		self.strings=set()
+
+	def add(self,obj):
+		if isinstance(obj,unicode):
+			self.strings.add(obj.encode("utf-8"))
+
+	def freeze(self):
+		self.sorted_strings=sorted(self.strings)
+		self.ids=dict((s,i) for i,s in enumerate(self.sorted_strings))
+
+	def code(self,obj):
+		if isinstance(obj,unicode):
+			return self.ids[obj.encode("utf-8")]
+		else:
+			return (number_flag|obj)
+
+	def write(self,dest):
+		offset=0
+		for s in self.sorted_strings:
+			dest.write(struct.pack(">I",offset))
+			offset+=len(s)+1
+		for s in self.sorted_strings:
+			dest.write(s)
 			dest.write("\x00")
-		s=val.encode("utf-8")
-		dest.write(struct.pack("{}p".format(len(s)+1),s))
-	elif isinstance(val,int):
-		if typed:
-			dest.write("\x01")
-		dest.write(struct.pack("B",val))
-	else:
-		raise RuntimeError("Unexpected value type")
-
-def write_value(dest,val,typed=False):
-	if isinstance(val,list):
-		if typed:
-			write_single_value(dest,2)
-		write_single_value(dest,len(val))
-		for obj in val:
-			write_single_value(dest,obj,True)
-	else:
-		write_single_value(dest,val,typed)
-
-def write_node(dest,node):
-	if is_leaf(node):
-		write_value(dest,0)
-		write_value(dest,node[0][-1],True)
-	else:
-		write_value(dest,operators[node[0][1]])
-		write_value(dest,node[0][0])
-		write_value(dest,node[0][2],True)
-		write_node(dest,node[1])
-		write_node(dest,node[2])
+		dest.write("\x00"*(-offset%4))
+
+	def data_size(self):
+		return sum(len(s)+1 for s in self.sorted_strings)
+
+def flatten(tree):
+	nodes=list()
+	stack=[(tree,None,None)]
+	while stack:
+		node,parent,slot=stack.pop()
+		index=len(nodes)
+		if parent is not None:
+			nodes[parent][slot]=index
+		if is_leaf(node):
+			nodes.append([0,0,None,node[0][-1],0,0])
+		elif is_internal_node(node):
+			feature,op,val=node[0]
+			if op=="in":
+				val=[normalize(x) for x in val]
+			else:
+				val=normalize(val)
+			nodes.append([operators[op],0,feature,val,0,0])
+			stack.append((node[2],index,5))
+			stack.append((node[1],index,4))
+		else:
+			raise RuntimeError("Unsupported tree format")
+	return nodes
 
 def dump(dest,tree):
-	if not is_node(tree):
-		raise RuntimeError("Unsupported tree format")
-	write_node(dest,tree)
+	nodes=flatten(tree)
+	strings=string_table()
+	for n in nodes:
+		strings.add(n[2])
+		for obj in (n[3] if isinstance(n[3],list) else [n[3]]):
+			strings.add(obj)
+	strings.freeze()
+	features=list()
+	feature_ids=dict()
+	answers=list()
+	answer_ids=dict()
+	lists=list()
+	for n in nodes:
+		if n[0]==0:
+			code=strings.code(n[3])
+			if code not in answer_ids:
+				answer_ids[code]=len(answers)
+				answers.append(code)
+			n[3]=answer_ids[code]
+			continue
+		if n[2] not in feature_ids:
+			feature_ids[n[2]]=len(features)
+			features.append(strings.code(n[2]))
+		n[2]=feature_ids[n[2]]
+		if isinstance(n[3],list):
+			codes=sorted(set(strings.code(x) for x in n[3]))
+			if len(codes)>=(1<<24):
+				raise RuntimeError("The list is too long")
+			n[1]=len(codes)
+			n[3]=len(lists)
+			lists.extend(codes)
+		else:
+			n[3]=strings.code(n[3])
+	dest.write(magic)
+	dest.write(struct.pack(">7I",format_version,len(strings.sorted_strings),strings.data_size(),len(features),len(answers),len(lists),len(nodes)))
+	strings.write(dest)
+	for code in features+answers+lists:
+		dest.write(struct.pack(">I",code))
+	for n in nodes:
+		dest.write(struct.pack(">5I",(n[0]<<24)|n[1],n[2] or 0,n[3],n[4],n[5]))